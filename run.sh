@@ -20,8 +20,13 @@ SV_TYPES=($(echo "$SV_TYPES_CSV" | tr ',' ' '))
 SV_CALLS=(split_reads)  # manta delly lumpy)
 CV_MODES=(kfold)  # cross validation modes
 KFOLD=2  # k-fold cross validation
+CV_JOBS=1  # cross-validation folds trained at the same time, cores requested for the training
 EPOCHS=1  # epochs
 WIN_SZ=25  # window size in bp
+FUSED=true  # add the window channels while creating the windows
+CANDIDATES=false  # compute the per-base channels only around the split read candidates
+SPARSE=false  # store the mostly zero channels of the chromosome arrays as COO
+MULTICLASS=false  # train one multi-class model on the windows of all the SV types
 PREFIX="$BASE_DIR/$SAMPLE"
 FASTA="$PREFIX.fasta"
 TWOBIT="$PREFIX.2bit"
@@ -40,11 +45,12 @@ submit () {  # submit a job via Xenon CLI
   local xenon="xenon scheduler $SCH "
   local exec=$1
   local jobname=$2
+  local cores=${3:-1}
 
   if [ "$SCH" == 'local' ]; then
-    xenon+="exec --cores-per-task 1 "
+    xenon+="exec --cores-per-task $cores "
   else
-    xenon+="--location local:// submit --name '$jobname' --cores-per-task 1 \
+    xenon+="--location local:// submit --name '$jobname' --cores-per-task $cores \
       --stderr stderr-%j.log --stdout stdout-%j.log "
   fi
 
@@ -61,12 +67,17 @@ monitor () {  # monitor a job via Xenon CLI
   xenon --json scheduler $SCH --location local:// list --identifier $1
 }
 
-waiting () {  # wait until all jobs are done
+waiting () {  # wait until the given jobs, all jobs by default, are done
   if [ "$SCH" == 'local' ]; then
     return
   fi
 
-  for j in "${JOBS[@]}"; do
+  local jobs=("$@")
+  if [ $# -eq 0 ]; then
+    jobs=("${JOBS[@]}")
+  fi
+
+  for j in "${jobs[@]}"; do
     while true; do
       [[ $(monitor $j | grep -v "WARN" | jq '.statuses | .[] | select(.done==true)') ]] && \
         break || sleep ${SLTIME}m
@@ -105,28 +116,21 @@ for vcf in $(find "$BASE_DIR" -mindepth 1 -name "*.vcf" | grep -v "htz-sv*"); do
     JOBS+=($JOB_ID)
 done
 
-# submit jobs to output "channel" files (*.json.gz and *.npy.gz)
+# extract the informative reads and their mates into an evidence BAM
 cd ../genome_wide
-p=clipped_reads
-cmd="python $p.py \
-  -b \"$BAM\" \
-  -c \"$SEQ_IDS_CSV\" \
-  -o $p.json.gz \
-  -p . \
-  -l $p.log"
-JOB_ID=$(submit "$cmd" "$p")
-JOBS+=($JOB_ID)
-
-p=clipped_read_pos
+p=evidence_bam
 cmd="python $p.py \
   -b \"$BAM\" \
   -c \"$SEQ_IDS_CSV\" \
-  -o $p.json.gz \
   -p . \
   -l $p.log"
 JOB_ID=$(submit "$cmd" "$p")
 JOBS+=($JOB_ID)
+EVIDENCE_JOB=$JOB_ID
+EVIDENCE_BAM="$(realpath -s evidence_bam/evidence.bam)"
 
+# submit jobs to output "channel" files (*.json.gz and *.npy.gz)
+# the stages that read the full BAM file do not wait for the evidence BAM
 p=split_reads
 cmd="python $p.py \
   -b \"$BAM\" \
@@ -137,6 +141,13 @@ cmd="python $p.py \
   -l $p.log"
 JOB_ID=$(submit "$cmd" "$p")
 JOBS+=($JOB_ID)
+SPLIT_JOB=$JOB_ID
+
+CAND_ARGS=""
+if [ "$CANDIDATES" == true ]; then  # candidate regions are read from the split_reads output
+  waiting $SPLIT_JOB
+  CAND_ARGS="-cw $WIN_SZ"
+fi
 
 for s in "${SEQ_IDS[@]}"; do  # per chromosome
   p=clipped_read_distance
@@ -145,7 +156,7 @@ for s in "${SEQ_IDS[@]}"; do  # per chromosome
     -c $s \
     -o $p.json.gz \
     -p . \
-    -l $p.log"
+    -l $p.log $CAND_ARGS"
   JOB_ID=$(submit "$cmd" "$p-$s")
   JOBS+=($JOB_ID)
 
@@ -156,7 +167,7 @@ for s in "${SEQ_IDS[@]}"; do  # per chromosome
     -t \"$TWOBIT\" \
     -o $p.npy \
     -p . \
-    -l $p.log"
+    -l $p.log $CAND_ARGS"
   JOB_ID=$(submit "$cmd" "$p-$s")
   JOBS+=($JOB_ID)
 
@@ -166,11 +177,34 @@ for s in "${SEQ_IDS[@]}"; do  # per chromosome
     -c $s \
     -o $p.npy \
     -p . \
-    -l $p.log"
+    -l $p.log $CAND_ARGS"
   JOB_ID=$(submit "$cmd" "$p-$s")
   JOBS+=($JOB_ID)
 done
 
+# the clipped read channels only need the evidence BAM
+waiting $EVIDENCE_JOB
+
+p=clipped_reads
+cmd="python $p.py \
+  -b \"$EVIDENCE_BAM\" \
+  -c \"$SEQ_IDS_CSV\" \
+  -o $p.json.gz \
+  -p . \
+  -l $p.log"
+JOB_ID=$(submit "$cmd" "$p")
+JOBS+=($JOB_ID)
+
+p=clipped_read_pos
+cmd="python $p.py \
+  -b \"$EVIDENCE_BAM\" \
+  -c \"$SEQ_IDS_CSV\" \
+  -o $p.json.gz \
+  -p . \
+  -l $p.log"
+JOB_ID=$(submit "$cmd" "$p")
+JOBS+=($JOB_ID)
+
 waiting
 
 # generate chromosome arrays from the channels as well as label window pairs
@@ -182,7 +216,10 @@ for s in "${SEQ_IDS[@]}"; do
     -t \"$TWOBIT\" \
     -o $p.npy \
     -p . \
-    -l $p.log"
+    -l $p.log $CAND_ARGS"
+  if [ "$SPARSE" == true ]; then
+    cmd+=" --sparse"
+  fi
   JOB_ID=$(submit "$cmd" "$p-$s")
   JOBS+=($JOB_ID)
 done
@@ -223,6 +260,9 @@ for c in "${SV_CALLS[@]}"; do
           -w $WIN_SZ \
           -p \"$out\" \
           -l $p.log"
+        if [ "$FUSED" == true ]; then
+          cmd+=" --fused"
+        fi
         JOB_ID=$(submit "$cmd" "$p-$c-$sv")
         JOBS+=($JOB_ID)
     done
@@ -230,8 +270,9 @@ done
 
 waiting
 
-# Add window channels
-for c in "${SV_CALLS[@]}"; do
+# Add window channels (already added by create_window_pairs in fused mode)
+[ "$FUSED" == true ] && SV_CALLS_EN=() || SV_CALLS_EN=("${SV_CALLS[@]}")
+for c in "${SV_CALLS_EN[@]}"; do
     for sv in "${SV_TYPES[@]}"; do
         p=add_win_channels
         out="cnn/win$WIN_SZ/$c/windows/$sv"
@@ -253,24 +294,31 @@ done
 waiting
 
  # Train and test model
- for sv in "${SV_TYPES[@]}"; do
+ if [ "$MULTICLASS" == true ]; then  # one model, trained on the windows of all the SV types
+   TRAIN_SV_TYPES=("$SV_TYPES_CSV")
+ else
+   TRAIN_SV_TYPES=("${SV_TYPES[@]}")
+ fi
+ for sv in "${TRAIN_SV_TYPES[@]}"; do
      for c in "${SV_CALLS[@]}"; do
          for cv in "${CV_MODES[@]}"; do
              p=train
              out_dir="cnn/win$WIN_SZ/$c"
-             train_dir="$out_dir/windows/$sv/windows_en.npz"
+             train_dir=$(echo "$sv" | tr ',' '\n' | \
+               sed "s|.*|$out_dir/windows/&/windows_en.npz|" | paste -sd ',')
              cmd="python $p.py \
                --training_sample_name \"$SAMPLE\" \
                --training_windows \"$train_dir\" \
                --test_sample_name \"$SAMPLE\" \
                --test_windows \"$train_dir\" \
                -k $KFOLD \
+               -jobs $CV_JOBS \
                -e $EPOCHS \
                -p \"$out_dir\" \
                -s $sv \
                -cv $cv \
                -l $p.log"
-             JOB_ID=$(submit "$cmd" "$p-$sv-$c")
+             JOB_ID=$(submit "$cmd" "$p-$sv-$c" $CV_JOBS)
              JOBS+=($JOB_ID)
          done
      done
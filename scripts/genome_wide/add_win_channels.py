@@ -1,11 +1,16 @@
 import argparse
 import logging
+import multiprocessing
+import os
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
 from time import time
 
 import numpy as np
 import pysam
 from functions import (is_left_clipped, is_right_clipped, load_windows,
-                       save_windows)
+                       memmap_npz_array, preallocate_windows, save_windows_by_chunk,
+                       update_npz_crc)
 
 
 def init_log(logfile):
@@ -60,6 +65,22 @@ def parse_args():
                         type=int,
                         default=10,
                         help="Length of the padding in between windows")
+    parser.add_argument('-bs',
+                        '--batch_size',
+                        type=int,
+                        default=1000,
+                        help="Number of window pairs to keep in memory before writing them")
+    parser.add_argument('-sw',
+                        '--sweep',
+                        action='store_true',
+                        help="Assign reads to windows with one sweep over the reads of each batch "
+                             "instead of fetching the reads of every window")
+    parser.add_argument('-wk',
+                        '--workers',
+                        type=int,
+                        default=1,
+                        help="Number of worker processes, each one processing a contiguous "
+                             "shard of the windows")
 
     return parser.parse_args()
 
@@ -80,102 +101,319 @@ def get_channels():
     return {k: v for v, k in enumerate(ch)}
 
 
-def update_channel(X, ch, counter, read, win_mid_pos, is_second_win, win_len, padding):
-    if is_left_clipped(read) and not is_right_clipped(read):
-        clipping = 'L'
-    elif not is_left_clipped(read) and is_right_clipped(read):
-        clipping = 'R'
-    elif is_left_clipped(read) and is_right_clipped(read):
-        clipping = 'B'
-    else:
-        clipping = 'N'
-
+# bits of the read feature code
+READ_REVERSE = 1
+READ_CLIPPING_SHIFT = 1  # 2 bits: 0 not clipped, 1 left, 2 right, 3 both
+READ_STATE_SHIFT = 3  # 2 bits: 0 all reads, 1 clipped, 2 split
+READ_NOT_PROPER_PAIR = 1 << 5
+MATE_REVERSE = 1 << 6
+MATE_AFTER = 1 << 7
+MATE_BEFORE = 1 << 8
+MATE_OTHER_CHROM = 1 << 9
+N_READ_CODES = 1 << 10
+
+
+def get_channel_table(ch):
+    '''
+    Lookup table from read feature code (see get_read_features) to the indices of the channels that
+    a read increments
+    :param ch: dictionary of channel indices as returned by get_channels
+    :return: array with shape [N_READ_CODES, max channels per read], padded with -1
+    '''
+    clipping_list = ['N', 'L', 'R', 'B']
+    state_list = ['AR', 'CR', 'SR']
+    table = []
+    for code in range(N_READ_CODES):
+        is_reverse = bool(code & READ_REVERSE)
+        mate_is_reverse = bool(code & MATE_REVERSE)
+        mate_after = bool(code & MATE_AFTER)
+        mate_before = bool(code & MATE_BEFORE)
+        state = (code >> READ_STATE_SHIFT) & 3
+        keys = []
+        if state < len(state_list):
+            orientation = 'R' if is_reverse else 'F'
+            keys.append('_'.join([orientation, state_list[state],
+                                  clipping_list[(code >> READ_CLIPPING_SHIFT) & 3]]))
+            if code & READ_NOT_PROPER_PAIR:
+                keys.append('_'.join(['DR', orientation]))
+            if is_reverse and not mate_is_reverse and mate_after:
+                keys.append('DUP_A')
+            if not is_reverse and mate_is_reverse and mate_before:
+                keys.append('DUP_B')
+            if is_reverse == mate_is_reverse:
+                keys.append('INV_B' if mate_after else 'INV_A')
+                if code & MATE_OTHER_CHROM:
+                    keys.append('TRA_S' if mate_after else 'TRA_O')
+        table.append([ch[k] for k in keys if k in ch.keys()])
+    max_len = max(len(t) for t in table)
+    return np.array([t + [-1] * (max_len - len(t)) for t in table], dtype=np.int32)
+
+
+def get_read_features(read, win_mid_pos, is_second_win, win_len, padding):
+    '''
+    :param read: read object of the class pysam.AlignedSegment
+    :param win_mid_pos: center of the window
+    :param is_second_win: True if the window is the second window of the pair
+    :param win_len: window size, even
+    :param padding: length of the padding in between windows
+    :return: (code, rel_start, rel_end): the read feature code and the interval [rel_start, rel_end)
+    of the window pair incremented by the read. None if the read does not increment any position.
+    '''
+    left_clipped = is_left_clipped(read)
+    right_clipped = is_right_clipped(read)
     if read.has_tag('SA'):
-        clipped_state = 'SR'
-    elif is_left_clipped(read) or is_right_clipped(read):
-        clipped_state = 'CR'
+        state = 2
+    elif left_clipped or right_clipped:
+        state = 1
     else:
-        clipped_state = 'AR'
+        state = 0
+
+    code = state << READ_STATE_SHIFT | \
+        (left_clipped | right_clipped << 1) << READ_CLIPPING_SHIFT
+    if read.is_reverse:
+        code |= READ_REVERSE
+    if not read.is_proper_pair:
+        code |= READ_NOT_PROPER_PAIR
+    if read.mate_is_reverse:
+        code |= MATE_REVERSE
+    if read.reference_start < read.next_reference_start:
+        code |= MATE_AFTER
+    elif read.reference_start > read.next_reference_start:
+        code |= MATE_BEFORE
+    if read.reference_id != read.next_reference_id:
+        code |= MATE_OTHER_CHROM
 
-    orientation = 'R' if read.is_reverse else 'F'
     start_win = win_len + padding if is_second_win else 0
-    end_win = win_len * 2 + padding if is_second_win else win_len
-    abs_start = int(win_mid_pos - int(win_len / 2)) if win_len % 2 == 0 else \
-        int(win_mid_pos - int(win_len + 1 / 2))
-    abs_end = int(win_mid_pos + int(win_len / 2)) if win_len % 2 == 0 else \
-        int(win_mid_pos + int(win_len + 1 / 2))
-    start = max(read.reference_start, abs_start)
-    end = min(read.reference_end, abs_end)
-    rel_start = start_win + start - abs_start
-    rel_end = start_win + end - abs_start
-
-    assert rel_start >= 0
-    assert rel_end >= 0
+    end_win = start_win + win_len
+    abs_start = win_mid_pos - int(win_len / 2)
+    abs_end = win_mid_pos + int(win_len / 2)
+    rel_start = start_win + max(read.reference_start, abs_start) - abs_start
+    rel_end = start_win + min(read.reference_end, abs_end) - abs_start
+
     assert start_win <= rel_start <= end_win
     assert start_win <= rel_end <= end_win
 
-    skip = False
-    if is_left_clipped(read):
-        if (is_second_win and win_len + padding <= rel_start < win_len * 2 + padding) or \
-                (not is_second_win and 0 <= rel_start < win_len):
-            rel_pos = rel_start
-        else:
-            skip = True
-    elif is_right_clipped(read):
-        if (is_second_win and win_len + padding <= rel_end < win_len * 2 + padding) or \
-                (not is_second_win and 0 <= rel_end < win_len):
-            rel_pos = rel_end
-        else:
-            skip = True
-    else:
-        rel_pos = np.arange(max(start_win, rel_start), min(rel_end, end_win))
-
-    if not skip:
-        k = '_'.join([orientation, clipped_state, clipping])
-        if k in ch.keys():
-            X[counter, rel_pos, ch[k]] += 1
-        if not read.is_proper_pair:
-            k = '_'.join(['DR', orientation])
-            if k in ch.keys():
-                X[counter, rel_pos, ch[k]] += 1
-        if read.is_reverse and not read.mate_is_reverse \
-                and read.reference_start < read.next_reference_start:
-            k = '_'.join(['DUP', 'A'])
-            if k in ch.keys():
-                X[counter, rel_pos, ch[k]] += 1
-        if not read.is_reverse and read.mate_is_reverse \
-                and read.reference_start > read.next_reference_start:
-            k = '_'.join(['DUP', 'B'])
-            if k in ch.keys():
-                X[counter, rel_pos, ch[k]] += 1
-        if read.is_reverse == read.mate_is_reverse:
-            if read.reference_start < read.next_reference_start:
-                k = '_'.join(['INV', 'B'])
-                if k in ch.keys():
-                    X[counter, rel_pos, ch[k]] += 1
-            else:
-                k = '_'.join(['INV', 'A'])
-                if k in ch.keys():
-                    X[counter, rel_pos, ch[k]] += 1
-        if read.reference_name != read.next_reference_name:
-            if read.is_reverse == read.mate_is_reverse:
-                if read.reference_start < read.next_reference_start:
-                    k = '_'.join(['TRA', 'S'])
-                    if k in ch.keys():
-                        X[counter, rel_pos, ch[k]] += 1
-                else:
-                    k = '_'.join(['TRA', 'O'])
-                    if k in ch.keys():
-                        X[counter, rel_pos, ch[k]] += 1
+    if left_clipped:
+        # clipped reads increment the clipped position only
+        if rel_start < end_win:
+            return code, rel_start, rel_start + 1
+        return None
+    elif right_clipped:
+        if rel_end < end_win:
+            return code, rel_end, rel_end + 1
+        return None
+    return code, rel_start, rel_end
+
+
+def apply_channel_updates(X, ch_table, updates):
+    '''
+    Add the reads collected in updates to the window specific channels with a single vectorized
+    scatter-add over the difference array of the intervals
+    :param X: array of window specific channels with shape [n_window_pairs, window_pair_length,
+    n_channels]
+    :param ch_table: lookup table as returned by get_channel_table
+    :param updates: list of (window pair index, read code, rel_start, rel_end) tuples
+    :return: X
+    '''
+    if len(updates) == 0:
+        return X
+    counter, code, rel_start, rel_end = np.array(updates, dtype=np.int64).T
+    read_channels = ch_table[code]
+    read_idx, col_idx = np.nonzero(read_channels >= 0)
+    channel = read_channels[read_idx, col_idx]
+    diff = np.zeros(shape=(X.shape[0], X.shape[1] + 1, X.shape[2]), dtype=np.int32)
+    np.add.at(diff, (counter[read_idx], rel_start[read_idx], channel), 1)
+    np.add.at(diff, (counter[read_idx], rel_end[read_idx], channel), -1)
+    X += np.cumsum(diff, axis=1)[:, :-1].astype(X.dtype)
     return X
 
 
-def add_channels(args, aln):
+def add_common_read_channels(updates, counter, win1_reads, win2_reads, pos1, pos2, win, padding):
+    '''
+    Collect the channel updates of the window pair at index counter from the reads found in both
+    windows, see apply_channel_updates
+    :param updates: list of channel updates
+    :param counter: index of the window pair
+    :param win1_reads: list of (read ID, read) tuples overlapping the first window, where the read ID
+    is the hash of the read name
+    :param win2_reads: list of (read ID, read) tuples overlapping the second window
+    :param win: window size, even
+    :param padding: length of the padding in between windows
+    :return: updates
+    '''
+    # Which reads are in both windows?
+    common_read_ids = {read_id for read_id, r in win1_reads} & \
+        {read_id for read_id, r in win2_reads}
+
+    # Only consider reads common to both windows
+    for reads, pos, is_second_win in ((win1_reads, pos1, False), (win2_reads, pos2, True)):
+        for read_id, r in reads:
+            if read_id in common_read_ids and not r.is_unmapped:
+                features = get_read_features(r, pos, is_second_win, win, padding)
+                if features is not None:
+                    updates.append((counter,) + features)
+    return updates
+
+
+def add_win_pair_channels(aln, updates, counter, chrom1, pos1, chrom2, pos2, win, padding):
+    '''
+    Collect the channel updates of the window pair at index counter, fetching the reads of both
+    windows from the BAM file
+    :param aln: pysam.AlignmentFile
+    :return: updates
+    '''
+    def get_reads(chrom, pos):
+        return [(hash(read.query_name), read)
+                for read in aln.fetch(chrom, pos - int(win / 2), pos + int(win / 2))]
+
+    # Fetch reads overlapping each window
+    win1_reads = get_reads(chrom1, pos1)
+    win2_reads = get_reads(chrom2, pos2)
+    return add_common_read_channels(updates, counter, win1_reads, win2_reads, pos1, pos2,
+                                    win, padding)
+
+
+def get_window_reads(aln, anchors, win):
+    '''
+    Assign reads to all the windows they overlap with a single sweep over the reads of each
+    chromosome: windows are sorted by position and merged into regions, every read of a region is
+    fetched and decoded once.
+    :param aln: pysam.AlignmentFile
+    :param anchors: list of (chromosome, position) tuples, the centers of the windows
+    :param win: window size, even
+    :return: list with, for each anchor, the list of (read ID, read) tuples overlapping the window
+    '''
+    win_hlen = int(win / 2)
+    win_reads = [[] for _ in anchors]
+    anchors_by_chrom = defaultdict(list)
+    for k, (chrom, pos) in enumerate(anchors):
+        anchors_by_chrom[chrom].append((pos, k))
+
+    for chrom, chrom_anchors in anchors_by_chrom.items():
+        chrom_anchors.sort()
+        starts = [pos - win_hlen for pos, k in chrom_anchors]
+        ends = [pos + win_hlen for pos, k in chrom_anchors]
+
+        # regions of overlapping windows, as [first anchor, last anchor + 1)
+        regions = []
+        first = 0
+        for a in range(1, len(chrom_anchors) + 1):
+            if a == len(chrom_anchors) or starts[a] >= ends[a - 1]:
+                regions.append((first, a))
+                first = a
+
+        for first, last in regions:
+            for read in aln.fetch(chrom, starts[first], ends[last - 1]):
+                # unmapped reads placed at the position of their mate are kept as in fetch mode:
+                # they count for the reads common to both windows, see add_common_read_channels
+                read_id = hash(read.query_name)
+                read_end = read.reference_end if read.reference_end is not None \
+                    else read.reference_start + 1
+                # active windows: start < read end and end > read start
+                lo = bisect_right(ends, read.reference_start, first, last)
+                hi = bisect_left(starts, read_end, first, last)
+                for a in range(lo, hi):
+                    win_reads[chrom_anchors[a][1]].append((read_id, read))
+    return win_reads
+
+
+def get_win_channels(aln, win_ids, win_pair_len, win, padding, sweep, ch_table):
+    '''
+    Compute the window specific channels of a batch of window pairs
+    :param aln: pysam.AlignmentFile
+    :param win_ids: list of window pair IDs of the batch
+    :param win_pair_len: length of the window pairs, padding included
+    :param win: window size, even
+    :param padding: length of the padding in between windows
+    :param sweep: assign reads to windows with one sweep over the reads of the batch
+    :param ch_table: lookup table as returned by get_channel_table
+    :return: array of window specific channels with shape [n_window_pairs, window_pair_length,
+    n_channels]
+    '''
+    # Initialize numpy array for the current batch
+    X_enh = np.zeros(shape=(len(win_ids), win_pair_len, len(get_channels())), dtype=np.int8)
+    updates = []
+
+    if sweep:
+        anchors = []
+        for p in win_ids:
+            chrom1, pos1, chrom2, pos2, strand_info = p.split('_')
+            anchors.extend([(chrom1, int(pos1)), (chrom2, int(pos2))])
+        win_reads = get_window_reads(aln, anchors, win)
+
+    for j, p in enumerate(win_ids):
+        # Get genomic coordinates
+        chrom1, pos1, chrom2, pos2, strand_info = p.split('_')
+        pos1, pos2 = int(pos1), int(pos2)
+
+        if sweep:
+            updates = add_common_read_channels(updates, j, win_reads[2 * j],
+                                               win_reads[2 * j + 1], pos1, pos2,
+                                               win, padding)
+        else:
+            updates = add_win_pair_channels(aln, updates, j, chrom1, pos1, chrom2, pos2,
+                                            win, padding)
+
+    return apply_channel_updates(X_enh, ch_table, updates)
+
+
+def get_enhanced_batch(args, aln, X, win_ids, b_start, b_end, ch_table, last_t):
+    '''
+    Compute the window specific channels of the window pairs [b_start, b_end) and append them to the
+    windows of X
+    :param args: command line arguments
+    :param aln: pysam.AlignmentFile
+    :param X: array-like of windows
+    :param win_ids: list of window pair IDs
+    :param ch_table: lookup table as returned by get_channel_table
+    :param last_t: time of the last log message
+    :return: windows of the batch with the window specific channels, time of the last log message
+    '''
     win = args.win if args.win % 2 == 0 else args.win + 1
+    X_enh = get_win_channels(aln, win_ids[b_start:b_end], X.shape[1], win, args.padding,
+                             args.sweep, ch_table)
+    # Every n_r positions, write log informations
+    if b_end // args.log_every_n_pos > b_start // args.log_every_n_pos:
+        # Record the current time
+        now_t = time()
+        logging.info("%d positions processed (%f positions / s)" %
+                     (b_end, args.log_every_n_pos / (now_t - last_t)))
+        last_t = now_t
+    return np.concatenate((X[b_start:b_end], X_enh), axis=2), last_t
+
+
+def count_channels(X_batch, n_win_channels, nonzero_cnt, nan_cnt):
+    nonzero_cnt[:] += np.count_nonzero(X_batch[:, :, -n_win_channels:], axis=(0, 1))
+    nan_cnt[:] += np.count_nonzero(np.isnan(X_batch), axis=(0, 1))
+
+
+def add_channels_shard(args, shard_start, shard_end):
+    '''
+    Worker of the parallel mode: computes the windows [shard_start, shard_end) with its own BAM file
+    handle and writes them directly into the array of windows of the output npz file
+    :param args: command line arguments
+    :return: counts of non-zero elements of the window specific channels and of NaN elements
+    '''
+    X, y = load_windows(args.input)
+    win_ids = list(y.keys())
+    ch_table = get_channel_table(get_channels())
+    out = memmap_npz_array(args.output, 'data', mode='r+')
+    nonzero_cnt = np.zeros(len(get_channels()), dtype=np.int64)
+    nan_cnt = np.zeros(out.shape[2], dtype=np.int64)
+    last_t = time()
+    with pysam.AlignmentFile(args.bam, "rb") as aln:
+        for b_start in range(shard_start, shard_end, args.batch_size):
+            b_end = min(b_start + args.batch_size, shard_end)
+            X_batch, last_t = get_enhanced_batch(args, aln, X, win_ids, b_start, b_end,
+                                                 ch_table, last_t)
+            count_channels(X_batch, len(nonzero_cnt), nonzero_cnt, nan_cnt)
+            out[b_start:b_end] = X_batch
+            out.flush()
+    del out
+    return nonzero_cnt, nan_cnt
 
-    def get_reads(chrom, pos):
-        return [read for read in aln.fetch(chrom, pos - int(win / 2), pos + int(win / 2))]
 
+def add_channels(args, aln):
     # Load the windows
     logging.info("Loading windows...")
     last_t = time()
@@ -184,58 +422,46 @@ def add_channels(args, aln):
 
     # Load the channels
     ch = get_channels()
-    # get starting time
-    last_t = time()
-    # Initialize numpy array
-    X_enh = np.zeros(shape=(X.shape[:2] + (len(ch),)), dtype=np.int8)
-
-    for i, p in enumerate(y.keys(), start=0):
-        # Every n_r alignments, write log informations
-        if not i % args.log_every_n_pos and i != 0:
-            # Record the current time
-            now_t = time()
-            logging.info("%d positions processed (%f positions / s)" %
-                         (i, args.log_every_n_pos / (now_t - last_t)))
+    ch_table = get_channel_table(ch)
+    n_channels = X.shape[2] + len(ch)
+    nonzero_cnt = np.zeros(len(ch), dtype=np.int64)
+    nan_cnt = np.zeros(n_channels, dtype=np.int64)
+    win_ids = list(y.keys())
+    shape = X.shape[:2] + (n_channels,)
+    dtype = np.result_type(X.dtype, np.int8)
+
+    if args.workers > 1:
+        # contiguous shards of windows, written by the workers in place into the output npz file
+        preallocate_windows(args.output, shape, dtype, y)
+        bounds = np.linspace(0, len(win_ids), args.workers + 1).astype(int)
+        shards = [(args, bounds[k], bounds[k + 1]) for k in range(args.workers)
+                  if bounds[k] < bounds[k + 1]]
+        logging.info("Processing %d shards with %d workers" % (len(shards), args.workers))
+        with multiprocessing.Pool(args.workers) as pool:
+            for shard_nonzero_cnt, shard_nan_cnt in pool.starmap(add_channels_shard, shards):
+                nonzero_cnt += shard_nonzero_cnt
+                nan_cnt += shard_nan_cnt
+        update_npz_crc(args.output, 'data')
+    else:
+        def enhanced_batches():
             last_t = time()
+            for b_start in range(0, len(win_ids), args.batch_size):
+                b_end = min(b_start + args.batch_size, len(win_ids))
+                X_batch, last_t = get_enhanced_batch(args, aln, X, win_ids, b_start, b_end,
+                                                     ch_table, last_t)
+                count_channels(X_batch, len(ch), nonzero_cnt, nan_cnt)
+                yield X_batch
 
-        # Get genomic coordinates
-        chrom1, pos1, chrom2, pos2, strand_info = p.split('_')
-        pos1, pos2 = int(pos1), int(pos2)
-
-        # Fetch reads overlapping each window
-        win1_reads = get_reads(chrom1, pos1)
-        win2_reads = get_reads(chrom2, pos2)
-
-        # Which reads are in both windows?
-        win1_read_names_set = {read.query_name for read in win1_reads}
-        win2_read_names_set = {read.query_name for read in win2_reads}
-        common_read_names = win1_read_names_set & win2_read_names_set
-
-        # Only consider reads common to both windows
-        win1_reads = {
-            r for r in win1_reads if r.query_name in common_read_names and not r.is_unmapped}
-        win2_reads = {
-            r for r in win2_reads if r.query_name in common_read_names and not r.is_unmapped}
+        save_windows_by_chunk(args.output, enhanced_batches(), shape, dtype, y)
+    print(shape)
 
-        for r in win1_reads:
-            X_enh = update_channel(X_enh, ch, i, r, pos1,
-                                   False, win, args.padding)
-
-        for r in win2_reads:
-            X_enh = update_channel(X_enh, ch, i, r, pos2,
-                                   True, win, args.padding)
-
-    for i in np.arange(X_enh.shape[2]):
+    for i in np.arange(len(ch)):
         logging.info("win channels array: non-zero elements at index %d:%d" %
-                     (i, np.argwhere(X_enh[i, :] != 0).shape[0]))
-
-    X = np.concatenate((X, X_enh), axis=2)
-    print(X.shape)
+                     (i, nonzero_cnt[i]))
 
-    for i in np.arange(X.shape[2]):
+    for i in np.arange(n_channels):
         logging.info("full channels array: NaN elements at index %d:%d" %
-                     (i, len(np.argwhere(np.isnan(X[i, :])))))
-    return X, y
+                     (i, nan_cnt[i]))
 
 
 def main():
@@ -244,8 +470,7 @@ def main():
     t0 = time()
 
     with pysam.AlignmentFile(args.bam, "rb") as bam:
-        X, y = add_channels(args, bam)
-        save_windows(X, y, args.output)
+        add_channels(args, bam)
     logging.info('Finished in %f seconds' % (time() - t0))
 
 
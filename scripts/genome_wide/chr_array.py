@@ -3,7 +3,6 @@ import gzip
 import json
 import logging
 import os
-import statistics
 from collections import defaultdict
 from time import time
 
@@ -89,13 +88,45 @@ def load_channel(chr_list, outDir, ch):
     return channel_data
 
 
-def create_carray(ibam, chrom, twobit, outDir, cmd_name):
-
+def create_carray(ibam, chrom, twobit, outDir, cmd_name, regions=None, sparse=False):
+    '''
+    :param regions: array of regions [start, end) to consider, the whole chromosome if None. The
+    chromosome array then holds the concatenation of the regions, the regions are saved next to it.
+    :param sparse: store only the dense channels (coverage, SNVs, reference) in the carray and the
+    other channels, mostly zero, as sorted COO next to it. The event channels are then collected as
+    COO entries and the full chromosome array is never allocated.
+    '''
     chrlen = get_chr_len(ibam, chrom)
     channel_index = 0
     n_channels = 53
-
-    chr_array = np.zeros(shape=(chrlen, n_channels), dtype=np.float64)
+    n_rows = chrlen if regions is None else int(get_region_offsets(regions)[-1])
+
+    if sparse:
+        # dense channels, concatenated at the end, and (rows, channel, values) of the event channels
+        dense_arrays = []
+        events = []
+    else:
+        chr_array = np.zeros(shape=(n_rows, n_channels), dtype=np.float64)
+    dense_channels = []
+
+    def set_positions(idx, vals, ch_index):
+        # positions to rows of the chromosome array, positions outside the regions are dropped
+        if regions is not None:
+            idx = get_region_rows(regions, idx)
+            vals = vals[idx >= 0]
+            idx = idx[idx >= 0]
+        if sparse:
+            events.append((idx, ch_index, vals))
+        else:
+            chr_array[idx, ch_index] = vals
+        return vals
+
+    def set_dense(vals, ch_index):
+        if sparse:
+            dense_arrays.append(np.asarray(vals, dtype=np.float32))
+        else:
+            chr_array[:, ch_index:ch_index + vals.shape[1]] = vals
+        dense_channels.extend(range(ch_index, ch_index + vals.shape[1]))
 
     # dictionary of key choices
     direction_list = {
@@ -133,10 +164,7 @@ def create_carray(ibam, chrom, twobit, outDir, cmd_name):
             #     channel_data[chrom][current_channel] = np.delete(channel_data[chrom][current_channel], 2, 0)
 
             ch_num = channel_data[chrom][current_channel].shape[1]
-
-            chr_array[:, channel_index:channel_index +
-                      ch_num] = channel_data[chrom][current_channel][:
-                                                                     chrlen, :]
+            set_dense(channel_data[chrom][current_channel][:n_rows, :], channel_index)
             channel_index += ch_num
             del channel_data[chrom][current_channel]
 
@@ -151,8 +179,9 @@ def create_carray(ibam, chrom, twobit, outDir, cmd_name):
                                        [split_direction].values(),
                                        dtype=np.float32)
                     if len(idx) > 0:
-                        chr_array[idx, channel_index] = vals
-                        assert chr_array[idx, channel_index].any(), \
+                        vals = set_positions(idx, vals, channel_index)
+                    if len(vals) > 0:
+                        assert vals.any(), \
                             print('{}:{} is all zeros!'.format(
                                 current_channel, split_direction))
 
@@ -160,44 +189,28 @@ def create_carray(ibam, chrom, twobit, outDir, cmd_name):
                 del channel_data[chrom][current_channel][split_direction]
 
         elif current_channel == 'clipped_read_distance':
+            # median distances per position, as reduced by clipped_read_distance.py
             for split_direction in direction_list[current_channel]:
                 for clipped_arrangement in ['left', 'right', 'all']:
-                    idx = np.array(
-                        list(
-                            map(
-                                int, channel_data[chrom][current_channel]
-                                [split_direction]
-                                [clipped_arrangement].keys())))
-
-                    vals = np.array(
-                        list(
-                            map(
-                                statistics.median, channel_data[chrom]
-                                [current_channel][split_direction]
-                                [clipped_arrangement].values())))
-
-                    if len(idx) > 0:
-                        chr_array[idx, channel_index] = vals
+                    median_dist = channel_data[chrom][current_channel][split_direction][
+                        clipped_arrangement]
+                    if len(median_dist) > 0:
+                        idx = np.fromiter(median_dist.keys(), dtype=int)
+                        vals = np.fromiter(median_dist.values(), dtype=np.float64)
+                        set_positions(idx, vals, channel_index)
                     channel_index += 1
 
                     del channel_data[chrom][current_channel][split_direction][
                         clipped_arrangement]
 
         elif current_channel == 'split_read_distance':
+            # median distances per position, as reduced by split_reads.py
             for split_direction in direction_list[current_channel]:
-                idx = np.array(
-                    list(
-                        map(
-                            int, channel_data[chrom][current_channel]
-                            [split_direction].keys())))
-
-                vals = np.array(
-                    list(
-                        map(
-                            statistics.median, channel_data[chrom]
-                            [current_channel][split_direction].values())))
-                if len(idx) > 0:
-                    chr_array[idx, channel_index] = vals
+                median_dist = channel_data[chrom][current_channel][split_direction]
+                if len(median_dist) > 0:
+                    idx = np.fromiter(median_dist.keys(), dtype=int)
+                    vals = np.fromiter(median_dist.values(), dtype=np.float64)
+                    set_positions(idx, vals, channel_index)
                 channel_index += 1
 
                 del channel_data[chrom][current_channel][split_direction]
@@ -206,14 +219,32 @@ def create_carray(ibam, chrom, twobit, outDir, cmd_name):
     logging.info("Adding channel %s at index %d" %
                  (current_channel, channel_index))
     nuc_list = ['A', 'T', 'C', 'G', 'N']
-    chr_array[:, channel_index:channel_index +
-              len(nuc_list)] = get_one_hot_sequence_by_list(twobit, chrom, list(np.arange(chrlen)))
+    positions = np.arange(chrlen) if regions is None else get_region_positions(regions)
+    set_dense(get_one_hot_sequence_by_list(twobit, chrom, list(positions)), channel_index)
     channel_index += len(nuc_list)
-    logging.info("chr_array shape: %s" % str(chr_array.shape))
     outfile = os.path.join(outDir, cmd_name, chrom + '_carray')
+    events_file = os.path.join(outDir, cmd_name, chrom + '_events.npz')
+    if sparse:
+        chr_array = np.concatenate(dense_arrays, axis=1)
+        del dense_arrays
+        logging.info("Writing %d event channels as COO..." % (n_channels - len(dense_channels)))
+        save_sparse_channels(events_file, n_rows, events, dense_channels, n_channels)
+    elif os.path.exists(events_file):
+        os.remove(events_file)
+    logging.info("chr_array shape: %s" % str(chr_array.shape))
     logging.info("Writing carray...")
     a = bz.carray(chr_array, rootdir=outfile, mode='w')
     a.flush()
+    logging.info("%d bytes written" % sum(
+        os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(outfile)
+        for f in files))
+    if sparse:
+        logging.info("%d bytes of event channels written" % os.path.getsize(events_file))
+    regions_file = os.path.join(outDir, cmd_name, chrom + '_regions.npz')
+    if regions is not None:
+        np.savez(regions_file, regions=regions, chr_len=chrlen)
+    elif os.path.exists(regions_file):
+        os.remove(regions_file)
 
 
 def main():
@@ -255,6 +286,16 @@ def main():
                         type=str,
                         default=200,
                         help="Specify window size")
+    parser.add_argument('-cw',
+                        '--candidate_window',
+                        type=int,
+                        default=0,
+                        help='If > 0, store only the windows of this size centered on the '
+                             'candidate breakpoints found by split_reads.py')
+    parser.add_argument('-sp',
+                        '--sparse',
+                        action='store_true',
+                        help='Store the mostly zero channels as sorted COO next to the carray')
 
     args = parser.parse_args()
     cmd_name = 'chr_array'
@@ -268,11 +309,20 @@ def main():
                         level=logging.INFO)
 
     t0 = time()
+    regions = None
+    if args.candidate_window > 0:
+        regions = get_candidate_regions(
+            os.path.join(args.outputpath, 'split_reads', 'split_reads.json.gz'),
+            args.chr, args.candidate_window, get_chr_len(args.bam, args.chr))
+        logging.info('%d candidate regions covering %d positions' %
+                     (len(regions), (regions[:, 1] - regions[:, 0]).sum()))
     create_carray(ibam=args.bam,
                   chrom=args.chr,
                   twobit=args.twobit,
                   outDir=args.outputpath,
-                  cmd_name=cmd_name)
+                  cmd_name=cmd_name,
+                  regions=regions,
+                  sparse=args.sparse)
     logging.info('Elapsed time channel_maker_real = %f mins' % (time() - t0))
 
 
@@ -3,18 +3,18 @@ import gzip
 import json
 import logging
 import os
-from collections import defaultdict
 from time import time
 
 import pysam
 from functions import *
 
 
-def get_clipped_read_distance(ibam, chrName, min_mapq, outFile):
+def get_clipped_read_distance(ibam, chrName, min_mapq, outFile, regions=None):
     '''
     :param ibam: BAM file in input
     :param chrName: chromosome to consider
     :param outFile: output file where to store the clipped_read_distance dictionary
+    :param regions: array of regions [start, end) to consider, the whole chromosome if None
     :return:
     '''
     bamfile = pysam.AlignmentFile(ibam, "rb")
@@ -23,7 +23,7 @@ def get_clipped_read_distance(ibam, chrName, min_mapq, outFile):
     header_dict = bamfile.header
     chrLen = [i['LN'] for i in header_dict['SQ'] if i['SN'] == chrName][0]
 
-    # Dictionary with positions as keys and list of clipped read distances as values
+    # Clipped read distances by position, reduced to the median distance per position
     clipped_read_distance = dict()
     # For clipped reads mapped in the forward and reverse orientation
     for direction in ['forward', 'reverse']:
@@ -31,60 +31,71 @@ def get_clipped_read_distance(ibam, chrName, min_mapq, outFile):
         # For left- and right-clipped reads
         for clipped_arrangement in ['left', 'right', 'all']:
             clipped_read_distance[direction][
-                clipped_arrangement] = defaultdict(list)
+                clipped_arrangement] = GroupedMedian()
 
     def set_distance(direction, read, dist):
         '''
         :param direction: forward/reverse read direction
         :param read: read object of the class pysam.AlignedSegment
         :param dist: read to mate distance
-        :return: None. Adds dist to the list of distances at a clipped read position for a certain read direction
+        :return: None. Adds dist to the distances at a clipped read position for a certain read direction
         '''
         if direction == 'forward':
             pos = read.reference_end + 1
         elif direction == 'reverse':
             pos = read.reference_start
-        clipped_read_distance[direction]['all'][pos].append(dist)
+        clipped_read_distance[direction]['all'].append(pos, dist)
 
         if is_left_clipped(read):
             pos = read.reference_start
-            # if pos not in clipped_read_distance[direction]['left'].keys():
-            #    clipped_read_distance[direction]['left'][pos] = [dist]
-            # else:
-            clipped_read_distance[direction]['left'][pos].append(dist)
+            clipped_read_distance[direction]['left'].append(pos, dist)
         elif is_right_clipped(read):
             pos = read.reference_end + 1
-            # if pos not in clipped_read_distance[direction]['right'].keys():
-            #    clipped_read_distance[direction]['right'][pos] = [dist]
-            # else:
-            clipped_read_distance[direction]['right'][pos].append(dist)
+            clipped_read_distance[direction]['right'].append(pos, dist)
 
-    # Consider all the chromosome: interval [0, chrLen]
-    start_pos = 0
-    stop_pos = chrLen
+    if regions is None:
+        # Consider all the chromosome: interval [0, chrLen]
+        fetch_regions = [(0, chrLen)]
+    else:
+        # Clipped read positions can be up to 2 bp after the end of the read
+        fetch_regions = merge_regions(regions[:, 0] - 2, regions[:, 1], chrLen)
     # Log information every n_r reads
     n_r = 10 ** 6
     last_t = time()
-    for i, read in enumerate(bamfile.fetch(chrName, start_pos, stop_pos), start=1):
-        if not i % n_r:
-            now_t = time()
-            logging.info("%d alignments processed (%f alignments / s)" %
-                         (i, n_r / (now_t - last_t)))
-            last_t = time()
+    i = 0
+    prev_stop_pos = 0
+    for start_pos, stop_pos in fetch_regions:
+        for read in bamfile.fetch(chrName, start_pos, stop_pos):
+            # Skip the reads already fetched with the previous region
+            if read.reference_start < prev_stop_pos:
+                continue
+            i += 1
+            if not i % n_r:
+                now_t = time()
+                logging.info("%d alignments processed (%f alignments / s)" %
+                             (i, n_r / (now_t - last_t)))
+                last_t = time()
 
-        # Both read and mate should be mapped
-        if not read.is_unmapped and not read.mate_is_unmapped and read.mapping_quality >= min_mapq:
-            # Read and mate should be mapped on the same chromosome
-            if read.reference_name == read.next_reference_name:
-                # Calculate absolute read to mate distance
-                dist = abs(read.reference_start - read.next_reference_start)
-                dist = (dist - bam_mean) / bam_stddev
-                # Read is mapped in forward orientation, mate is in reverse orientation, read is mapped before mate
-                if not read.is_reverse and read.mate_is_reverse and read.reference_start <= read.next_reference_start:
-                    set_distance('forward', read, dist)
-                # Read is mapped in reverse orientation, mate is in forward orientation, read is mapped after mate
-                elif read.is_reverse and not read.mate_is_reverse and read.reference_start > read.next_reference_start:
-                    set_distance('reverse', read, dist)
+            # Both read and mate should be mapped
+            if not read.is_unmapped and not read.mate_is_unmapped and read.mapping_quality >= min_mapq:
+                # Read and mate should be mapped on the same chromosome
+                if read.reference_name == read.next_reference_name:
+                    # Calculate absolute read to mate distance
+                    dist = abs(read.reference_start - read.next_reference_start)
+                    dist = (dist - bam_mean) / bam_stddev
+                    # Read is mapped in forward orientation, mate is in reverse orientation, read is mapped before mate
+                    if not read.is_reverse and read.mate_is_reverse and read.reference_start <= read.next_reference_start:
+                        set_distance('forward', read, dist)
+                    # Read is mapped in reverse orientation, mate is in forward orientation, read is mapped after mate
+                    elif read.is_reverse and not read.mate_is_reverse and read.reference_start > read.next_reference_start:
+                        set_distance('reverse', read, dist)
+
+        prev_stop_pos = stop_pos
+
+    for direction in clipped_read_distance.keys():
+        for clipped_arrangement in clipped_read_distance[direction].keys():
+            clipped_read_distance[direction][clipped_arrangement] = \
+                clipped_read_distance[direction][clipped_arrangement].median_dict()
 
     # Write clipped read distance dictionaries
     with gzip.GzipFile(outFile, 'w') as fout:
@@ -123,6 +134,12 @@ def main():
                         type=int,
                         default=10,
                         help='Minimum read mapping quality')
+    parser.add_argument('-cw',
+                        '--candidate_window',
+                        type=int,
+                        default=0,
+                        help='If > 0, consider only the windows of this size centered on the '
+                             'candidate breakpoints found by split_reads.py')
     args = parser.parse_args()
     cmd_name = 'clipped_read_distance'
     output_dir = os.path.join(args.outputpath, cmd_name)
@@ -135,10 +152,20 @@ def main():
                         filemode='w',
                         level=logging.INFO)
     t0 = time()
+    regions = None
+    if args.candidate_window > 0:
+        with pysam.AlignmentFile(args.bam, 'rb') as bam:
+            chr_len = bam.get_reference_length(args.chr)
+        regions = get_candidate_regions(
+            os.path.join(args.outputpath, 'split_reads', 'split_reads.json.gz'),
+            args.chr, args.candidate_window, chr_len)
+        logging.info('%d candidate regions covering %d positions' %
+                     (len(regions), (regions[:, 1] - regions[:, 0]).sum()))
     get_clipped_read_distance(ibam=args.bam,
                               chrName=args.chr,
                               min_mapq=args.min_mapq,
-                              outFile=output_file)
+                              outFile=output_file,
+                              regions=regions)
     logging.info('Time: clipped read distance on BAM %s and Chr %s: %f' %
                  (args.bam, args.chr, (time() - t0)))
 
@@ -1,5 +1,6 @@
 import argparse
 import gzip
+import heapq
 import json
 import logging
 import os
@@ -26,14 +27,18 @@ def get_clipped_read_positions(ibam, chr_list, outFile):
     # List to store the clipped read positions
     right_clipped_pos = defaultdict(list, {k: [] for k in chr_list})
     left_clipped_pos = defaultdict(list, {k: [] for k in chr_list})
-    right_clipped_pos_by_query = dict()
-    left_clipped_pos_by_query = dict()
+    # Clipped reads waiting for their mate, by mate position (reference ID, start):
+    # {read ID: (chromosome, clipped position)}, where the read ID is the hash of the read name
+    left_clipped_by_mate_pos = defaultdict(dict)
+    right_clipped_by_mate_pos = defaultdict(dict)
+    # Heap of the mate positions waiting, the clipped reads are evicted once the sweep over the
+    # coordinate sorted BAM file passes the position of their mate
+    mate_pos_heap = []
+    max_waiting = 0
     # Print every n_r alignments processed
     n_r = 10 ** 6
     # Record the current time
     last_t = time()
-    rc_mate_set = defaultdict(set)
-    lc_mate_set = defaultdict(set)
 
     for i, read in enumerate(bamfile.fetch(), start=1):
         # Every n_r alignments, write log informations
@@ -41,38 +46,53 @@ def get_clipped_read_positions(ibam, chr_list, outFile):
             # Record the current time
             now_t = time()
             # print(type(now_t))
-            logging.info("%d alignments processed (%f alignments / s)" %
-                         (i, n_r / (now_t - last_t)))
+            logging.info("%d alignments processed (%f alignments / s), %d mate positions waiting" %
+                         (i, n_r / (now_t - last_t), len(mate_pos_heap)))
             last_t = time()
 
+        read_pos = (read.reference_id, read.reference_start)
+        # Evict the clipped reads whose mate can no longer be found
+        while mate_pos_heap and mate_pos_heap[0] < read_pos:
+            mate_pos = heapq.heappop(mate_pos_heap)
+            left_clipped_by_mate_pos.pop(mate_pos, None)
+            right_clipped_by_mate_pos.pop(mate_pos, None)
+
         # Both read and mate should be mapped, read should have a minimum mapping quality
         # if (not read.is_unmapped) and (not read.mate_is_unmapped) and read.mapping_quality >= minMAPQ:
         if (not read.is_unmapped) and read.mapping_quality >= minMAPQ and not has_suppl_aln(read):
-            if (read.query_name, read.reference_start
-                ) in lc_mate_set[read.next_reference_name]:
-                if read.query_name in left_clipped_pos_by_query.keys():
-                    left_clipped_pos[read.next_reference_name].append(
-                        left_clipped_pos_by_query[read.query_name])
-
-            if (read.query_name, read.reference_start
-                ) in rc_mate_set[read.next_reference_name]:
-                if read.query_name in right_clipped_pos_by_query.keys():
-                    right_clipped_pos[read.next_reference_name].append(
-                        right_clipped_pos_by_query[read.query_name])
-
-            if is_left_clipped(read):
-                # read.reference_start is the 1-based start position of the read mapped on the reference genome
-                left_clipped_pos_by_query[
-                    read.query_name] = read.reference_start + 1
-                lc_mate_set[read.reference_name].add(
-                    (read.query_name, read.next_reference_start))
-
-            if is_right_clipped(read):
-                # read.reference_end is the 0-based end position of the read mapped on the reference genome
-                right_clipped_pos_by_query[
-                    read.query_name] = read.reference_end
-                rc_mate_set[read.reference_name].add(
-                    (read.query_name, read.next_reference_start))
+            read_id = hash(read.query_name)
+
+            # Is the read the mate of a clipped read?
+            for clipped_by_mate_pos, clipped_pos in (
+                    (left_clipped_by_mate_pos, left_clipped_pos),
+                    (right_clipped_by_mate_pos, right_clipped_pos)):
+                if read_pos in clipped_by_mate_pos and \
+                        read_id in clipped_by_mate_pos[read_pos]:
+                    chrom, pos = clipped_by_mate_pos[read_pos][read_id]
+                    if chrom == read.next_reference_name:
+                        clipped_pos[chrom].append(pos)
+
+            left_clipped = is_left_clipped(read)
+            right_clipped = is_right_clipped(read)
+            mate_pos = (read.next_reference_id, read.next_reference_start)
+            # Mates before the current position have already been passed
+            if (left_clipped or right_clipped) and mate_pos >= read_pos:
+                if mate_pos not in left_clipped_by_mate_pos and \
+                        mate_pos not in right_clipped_by_mate_pos:
+                    heapq.heappush(mate_pos_heap, mate_pos)
+                    max_waiting = max(max_waiting, len(mate_pos_heap))
+
+                if left_clipped:
+                    # read.reference_start is the 1-based start position of the read mapped on the reference genome
+                    left_clipped_by_mate_pos[mate_pos][read_id] = \
+                        (read.reference_name, read.reference_start + 1)
+
+                if right_clipped:
+                    # read.reference_end is the 0-based end position of the read mapped on the reference genome
+                    right_clipped_by_mate_pos[mate_pos][read_id] = \
+                        (read.reference_name, read.reference_end)
+
+    logging.info("Maximum number of mate positions waiting: %d" % max_waiting)
 
     # Close the BAM file
     bamfile.close()
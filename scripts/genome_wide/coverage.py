@@ -6,7 +6,7 @@ from time import time
 import numpy as np
 import pysam
 
-from functions import get_insert_size
+from functions import get_candidate_regions, get_insert_size
 
 
 def is_discordant(read, bam_mean, bam_stddev):
@@ -32,47 +32,57 @@ def is_properly_mapped(read):
     return False
 
 
-def get_coverage(ibam, chrName, minMAPQ, outFile):
+def get_coverage(ibam, chrName, minMAPQ, outFile, regions=None):
     '''
     This function fills the coverage array for the chromosome
     :param ibam: input BAM alignment file
     :param chrName: chromosome name to consider
     :param outFile: output file for the coverage array
+    :param regions: array of regions [start, end) to consider, the whole chromosome if None. The
+    coverage array then holds the concatenation of the regions.
     :return: None
     '''
     bamfile = pysam.AlignmentFile(ibam, "rb")
     bam_mean, bam_stddev = get_insert_size(ibam, bamfile, minMAPQ)
     header_dict = bamfile.header
     chrLen = [i['LN'] for i in header_dict['SQ'] if i['SN'] == chrName][0]
-    start_pos = 0
-    stop_pos = chrLen
-    cov = np.zeros((chrLen, 5))
+    if regions is None:
+        regions = [(0, chrLen)]
+    cov = np.zeros((sum(end - start for start, end in regions), 5))
     n_r = 10 ** 6
     last_t = time()
-
-    for i, read in enumerate(bamfile.fetch(chrName, start_pos, stop_pos), start=1):
-        # Every n_r alignments, write log informations
-        if not i % n_r:
-            logging.info("%d alignments processed (%f alignments / s)" %
-                         (i, n_r / (time() - last_t)))
-            last_t = time()
-
-        if not read.is_unmapped and read.mapping_quality >= minMAPQ:
-            if is_properly_mapped(read):
-                cov[read.reference_start:read.reference_end - 1, 0] += 1
-            read_discordant = is_discordant(read, bam_mean, bam_stddev)
-
-            if not read.mate_is_unmapped:
-                if read_discordant:
-                    if read.is_reverse:
-                        cov[read.reference_start:read.reference_end - 1, 2] += 1
-                    else:
-                        cov[read.reference_start:read.reference_end - 1, 1] += 1
-                if not read.is_proper_pair:
-                    if read.is_reverse:
-                        cov[read.reference_start:read.reference_end - 1, 4] += 1
-                    else:
-                        cov[read.reference_start:read.reference_end - 1, 3] += 1
+    i = 0
+    offset = 0
+
+    for start_pos, stop_pos in regions:
+        for read in bamfile.fetch(chrName, start_pos, stop_pos):
+            i += 1
+            # Every n_r alignments, write log informations
+            if not i % n_r:
+                logging.info("%d alignments processed (%f alignments / s)" %
+                             (i, n_r / (time() - last_t)))
+                last_t = time()
+
+            if not read.is_unmapped and read.mapping_quality >= minMAPQ:
+                # rows of the read in the coverage array, clipped to the region
+                read_start = offset + max(read.reference_start, start_pos) - start_pos
+                read_end = offset + min(read.reference_end - 1, stop_pos) - start_pos
+                if is_properly_mapped(read):
+                    cov[read_start:read_end, 0] += 1
+                read_discordant = is_discordant(read, bam_mean, bam_stddev)
+
+                if not read.mate_is_unmapped:
+                    if read_discordant:
+                        if read.is_reverse:
+                            cov[read_start:read_end, 2] += 1
+                        else:
+                            cov[read_start:read_end, 1] += 1
+                    if not read.is_proper_pair:
+                        if read.is_reverse:
+                            cov[read_start:read_end, 4] += 1
+                        else:
+                            cov[read_start:read_end, 3] += 1
+        offset += stop_pos - start_pos
     logging.info(cov.shape)
 
     for i in np.arange(cov.shape[1]):
@@ -124,6 +134,12 @@ def main():
                         '--logfile',
                         default='coverage.log',
                         help='File in which to write logs.')
+    parser.add_argument('-cw',
+                        '--candidate_window',
+                        type=int,
+                        default=0,
+                        help='If > 0, consider only the windows of this size centered on the '
+                             'candidate breakpoints found by split_reads.py')
     args = parser.parse_args()
     cmd_name = 'coverage'
     output_dir = os.path.join(args.outputpath, cmd_name)
@@ -136,8 +152,17 @@ def main():
                         filemode='w',
                         level=logging.INFO)
     t0 = time()
+    regions = None
+    if args.candidate_window > 0:
+        with pysam.AlignmentFile(args.bam, 'rb') as bam:
+            chr_len = bam.get_reference_length(args.chr)
+        regions = get_candidate_regions(
+            os.path.join(args.outputpath, 'split_reads', 'split_reads.json.gz'),
+            args.chr, args.candidate_window, chr_len)
+        logging.info('%d candidate regions covering %d positions' %
+                     (len(regions), (regions[:, 1] - regions[:, 0]).sum()))
     get_coverage(ibam=args.bam, chrName=args.chr,
-                 minMAPQ=args.min_mapq, outFile=output_file)
+                 minMAPQ=args.min_mapq, outFile=output_file, regions=regions)
     logging.info('Time: coverage on BAM %s and Chr %s: %f' %
                  (args.bam, args.chr, (time() - t0)))
 
@@ -4,11 +4,17 @@ import itertools
 import json
 import logging
 import os
-from collections import Counter
+import random
+import re
+from collections import Counter, defaultdict
 from time import time
 
 import bcolz
 import numpy as np
+import pysam
+from add_win_channels import get_channel_table, get_channels, get_win_channels
+from functions import (LinkedWindows, RegionArray, SparseChrArray, save_window_table,
+                       save_windows_by_chunk)
 
 
 def get_range(dictionary, begin, end):
@@ -22,6 +28,16 @@ def load_chr_array(channel_data_dir, chrlist):
             channel_data_dir, 'chr_array', c + '_carray')
         logging.info("Loading file %s" % carray_file)
         chr_array[c] = bcolz.open(rootdir=carray_file)
+        # mostly zero channels stored as COO
+        events_file = os.path.join(channel_data_dir, 'chr_array', c + '_events.npz')
+        if os.path.exists(events_file):
+            chr_array[c] = SparseChrArray(chr_array[c], events_file)
+        # chromosome array stored only for the candidate regions
+        regions_file = os.path.join(channel_data_dir, 'chr_array', c + '_regions.npz')
+        if os.path.exists(regions_file):
+            with np.load(regions_file) as npzfile:
+                chr_array[c] = RegionArray(chr_array[c], npzfile['regions'], npzfile['chr_len'])
+            logging.info("%d candidate regions" % len(chr_array[c].regions))
         logging.info("Array shape: %s" % str(chr_array[c].shape))
     return chr_array
 
@@ -31,6 +47,89 @@ def get_labels(label_file):
         return json.loads(fin.read().decode('utf-8'))
 
 
+def iter_labels(label_file, chunk_size=2 ** 20):
+    '''
+    Iterate over the items of a label file without loading the whole file
+    :param label_file: gzipped JSON dictionary of window pair IDs (keys) and labels (values)
+    :param chunk_size: number of characters to read at once
+    :return: generator of (window pair ID, label) tuples, in file order
+    '''
+    item = re.compile(r'"([^"]*)":\s*"([^"]*)"')
+    buf = ''
+    with gzip.open(label_file, 'rt') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), ''):
+            buf += chunk
+            end = 0
+            # an item is only matched when its closing quote has been read
+            for m in item.finditer(buf):
+                yield m.group(1), m.group(2)
+                end = m.end()
+            buf = buf[end:]
+
+
+def is_positive(label):
+    return not label.startswith('no')
+
+
+def sample_labels(label_file, negative_ratio, seed):
+    '''
+    Sample the labels for a training set: all the positive window pairs and a random sample of the
+    negative window pairs, stratified by chromosome. The label file is streamed twice, once to count
+    the labels and once to draw the negatives with reservoir sampling, only the sampled labels are
+    kept in memory.
+    :param label_file: gzipped JSON dictionary of labels
+    :param negative_ratio: number of negatives to sample per positive
+    :param seed: seed of the random number generator
+    :return: dictionary of the sampled labels, in file order
+    '''
+    # first pass: count labels per chromosome and SV type
+    counts = Counter()
+    label_counts = Counter()
+    for win_id, label in iter_labels(label_file):
+        counts[(win_id.split('_', 1)[0], label)] += 1
+        label_counts[label] += 1
+    logging.info("%d labels found: %s" %
+                 (sum(label_counts.values()), str(label_counts)))
+
+    n_positive = sum(v for (c, l), v in counts.items() if is_positive(l))
+    strata = sorted(k for k in counts.keys() if not is_positive(k[1]))
+    n_negative = sum(counts[k] for k in strata)
+    n_sample = min(n_negative, int(round(negative_ratio * n_positive)))
+
+    # negatives to draw per stratum, proportional to the stratum size (largest remainder)
+    quota = dict()
+    if n_negative > 0:
+        raw = {k: n_sample * counts[k] / n_negative for k in strata}
+        quota = {k: int(v) for k, v in raw.items()}
+        remainder = sorted(strata, key=lambda k: raw[k] - quota[k], reverse=True)
+        for k in remainder[:n_sample - sum(quota.values())]:
+            quota[k] += 1
+
+    # second pass: keep all positives, reservoir sampling of negatives in each stratum
+    rng = random.Random(seed)
+    positives = []
+    reservoir = defaultdict(list)
+    seen = Counter()
+    for i, (win_id, label) in enumerate(iter_labels(label_file)):
+        if is_positive(label):
+            positives.append((i, win_id, label))
+            continue
+        k = (win_id.split('_', 1)[0], label)
+        seen[k] += 1
+        if len(reservoir[k]) < quota[k]:
+            reservoir[k].append((i, win_id, label))
+        else:
+            j = rng.randrange(seen[k])
+            if j < quota[k]:
+                reservoir[k][j] = (i, win_id, label)
+
+    sampled = positives + [s for k in strata for s in reservoir[k]]
+    sampled.sort()
+    logging.info("%d positives and %d negatives sampled (negative ratio %f, seed %d)" %
+                 (n_positive, n_sample, negative_ratio, seed))
+    return {win_id: label for i, win_id, label in sampled}
+
+
 def split_labels(labels):
     p = {}
     n = {}
@@ -49,65 +148,158 @@ def unfold_win_id(win_id):
     return chr1, pos1, chr2, pos2, strand_info
 
 
-def get_windows(carrays_dir, outDir, chrom_list, win, label_file_path, mode, npz_mode, padding_len):
+def get_window_table(chr_array, win_ids, win_hlen, table_file, batch_size):
+    '''
+    Extract each unique breakpoint window once. Window pairs that share a breakpoint, like split reads
+    clustering at the same position or INS pairs (p, p+1), refer to the same row of the table.
+    Windows not covered by the candidate regions of a RegionArray are read as zeros and counted.
+    :param chr_array: dictionary of chromosome arrays
+    :param win_ids: list of window pair IDs
+    :param win_hlen: half of the window size
+    :param table_file: file where the table of unique windows is stored (.npy)
+    :param batch_size: number of windows to keep in memory before writing them
+    :return: table of unique windows (memory-mapped) and array of indices into the table with shape
+    [n_pairs, 2]
+    '''
+    breakpoints = dict()
+    pairs = np.zeros(shape=(len(win_ids), 2), dtype=np.int64)
+    for i, (chr1, pos1, chr2, pos2, strand_info) in enumerate(map(unfold_win_id, win_ids)):
+        pairs[i, 0] = breakpoints.setdefault((chr1, pos1), len(breakpoints))
+        pairs[i, 1] = breakpoints.setdefault((chr2, pos2), len(breakpoints))
+    logging.info("%d unique windows for %d window pairs" %
+                 (len(breakpoints), len(win_ids)))
+
+    # sort the unique windows by position: overlapping windows are read from the chromosome array
+    # with a single slice
+    bp_sorted = sorted(breakpoints.keys())
+    new_index = np.zeros(len(bp_sorted), dtype=np.int64)
+    for i, bp in enumerate(bp_sorted):
+        new_index[breakpoints[bp]] = i
+    pairs = new_index[pairs]
+
+    # candidate region of each window, the windows of a slice are in the same region
+    region = np.zeros(len(bp_sorted), dtype=np.int64)
+    for i, (chrom, pos) in enumerate(bp_sorted):
+        if isinstance(chr_array[chrom], RegionArray):
+            region[i] = chr_array[chrom].get_region(pos - win_hlen, pos + win_hlen)
+    uncovered = np.flatnonzero(region < 0)
+    if len(uncovered) > 0:
+        logging.warning('%d windows not covered by the candidate regions, read as zeros (e.g. %s)' %
+                        (len(uncovered), '_'.join(map(str, bp_sorted[uncovered[0]]))))
+
+    chrom = bp_sorted[0][0] if len(bp_sorted) > 0 else None
+    n_channels = chr_array[chrom].shape[1] if chrom is not None else 0
+    dtype = chr_array[chrom].dtype if chrom is not None else np.float32
+    table = np.lib.format.open_memmap(table_file, mode='w+', dtype=dtype,
+                                      shape=(len(bp_sorted), 2 * win_hlen, n_channels))
+    max_span = batch_size * win_hlen
+    group_start = 0
+    for i in range(1, len(bp_sorted) + 1):
+        if i < len(bp_sorted) and bp_sorted[i][0] == bp_sorted[group_start][0] and \
+                bp_sorted[i][1] - bp_sorted[group_start][1] < max_span and \
+                i - group_start < batch_size and \
+                region[i] == region[group_start] and region[i] >= 0:
+            continue
+        chrom, first_pos = bp_sorted[group_start]
+        last_pos = bp_sorted[i - 1][1]
+        span = chr_array[chrom][first_pos - win_hlen:last_pos + win_hlen, :]
+        for j in range(group_start, i):
+            offset = bp_sorted[j][1] - first_pos
+            table[j] = span[offset:offset + 2 * win_hlen]
+        table.flush()
+        group_start = i
+    return table, pairs
+
+
+def get_windows(carrays_dir, outDir, chrom_list, win, label_file_path, mode, npz_mode, padding_len,
+                batch_size, window_table, negative_ratio=1.0, seed=1, bam=None, fused=False,
+                sweep=False):
     if win % 2 != 0:
         win += 1
     chr_array = load_chr_array(carrays_dir, chrom_list)
     n_channels = chr_array[chrom_list[0]].shape[1]
+    dtype = chr_array[chrom_list[0]].dtype
     logging.info("%d channels" % n_channels)
-    labels = get_labels(label_file_path)
-    logging.info("%d labels found: %s" %
-                 (len(labels), str(Counter(labels.values()))))
 
     if mode == 'training':
-        labels_positive = {k: v for k, v in labels.items() if v == 'DEL'}
-        labels_negative = {k: v for k, v in labels.items() if v == 'noDEL'}
-        labels_negative = get_range(
-            labels_negative, 0, len(labels_positive.keys()))
-        labels_set = {'positive': labels_positive, 'negative': labels_negative}
+        labels = sample_labels(label_file_path, negative_ratio, seed)
+        labels_set = {'training': labels}
     elif mode == 'test':
+        labels = get_labels(label_file_path)
+        logging.info("%d labels found: %s" %
+                     (len(labels), str(Counter(labels.values()))))
         labels_set = {'test': labels}
     win_hlen = int(int(win) / 2)
+    win_pair_len = win * 2 + padding_len
+
+    if fused:
+        # compute the window specific channels while the window pairs are composed
+        aln = pysam.AlignmentFile(bam, 'rb')
+        ch = get_channels()
+        ch_table = get_channel_table(ch)
+        n_win_channels = len(ch)
+        if window_table:
+            logging.info('Window table is not supported in fused mode, saving window pairs')
 
     for labs_name, labs in labels_set.items():
         logging.info("Creating %s..." % str(labs_name))
-        n_r = 10 ** 5
+        nonzero_cnt = np.zeros(n_channels, dtype=np.int64)
+        table_file = os.path.join(outDir, 'window_table.npy')
+        logging.info('Creating table of unique windows...')
         last_t = time()
-        i = 1
-        padding = np.zeros(shape=(padding_len, n_channels), dtype=np.float32)
-        if npz_mode:
-            numpy_array = []
-        logging.info('Creating np.arrays win1 and win2...')
-        for chr1, pos1, chr2, pos2, strand_info in map(unfold_win_id, labs.keys()):
-            if not i % n_r:
+        table, pairs = get_window_table(chr_array, list(labs.keys()), win_hlen,
+                                        table_file, batch_size)
+        logging.info("%d unique windows extracted (%f windows / s)" %
+                     (table.shape[0], table.shape[0] / max(time() - last_t, 1e-9)))
+        X = LinkedWindows(table, pairs, padding_len)
+
+        win_ids = list(labs.keys())
+
+        def window_batches():
+            # compose one batch of window pairs at a time, peak memory is bounded by batch_size
+            for b_start in range(0, X.shape[0], batch_size):
+                batch = X[b_start:b_start + batch_size]
+                nonzero_cnt[:] += np.count_nonzero(batch, axis=(0, 1))
+                yield batch
+
+        def enhanced_batches():
+            last_t = time()
+            for b_start, batch in zip(range(0, X.shape[0], batch_size), window_batches()):
+                b_end = b_start + batch.shape[0]
+                X_enh = get_win_channels(aln, win_ids[b_start:b_end], win_pair_len, win,
+                                         padding_len, sweep, ch_table)
+                now_t = time()
                 logging.info("%d window pairs processed (%f window pairs / s)" %
-                             (i, n_r / (time() - last_t)))
-                last_t = time()
-            partial_array = list()
-            d = chr_array[chr1][pos1 - win_hlen:pos1 + win_hlen, :]
-            partial_array.append(d)
-            partial_array.append(padding)
-            d = chr_array[chr2][pos2 - win_hlen:pos2 + win_hlen, :]
-            partial_array.append(d)
-
-            try:
-                full_array = np.concatenate(partial_array, axis=0)
-                if npz_mode:
-                    numpy_array.append(full_array)
-            except ValueError:
-                print('{}:{}-{}:{}'.format(chr1, pos1, chr2, pos2))
-                for d in numpy_array:
-                    print(d.shape)
-
-        if npz_mode:
-            numpy_array = np.stack(numpy_array, axis=0)
-            logging.info("Numpy array shape: %s" % str(numpy_array.shape))
-            for i in np.arange(numpy_array.shape[2]):
+                             (b_end, batch.shape[0] / max(now_t - last_t, 1e-9)))
+                last_t = now_t
+                yield np.concatenate((batch, X_enh), axis=2)
+
+        if npz_mode and fused:
+            logging.info('Creating np.arrays win1 and win2 with window channels...')
+            shape = (len(labs), win_pair_len, n_channels + n_win_channels)
+            save_windows_by_chunk(os.path.join(outDir, 'windows_en.npz'), enhanced_batches(),
+                                  shape, np.result_type(dtype, np.int8), labs)
+            logging.info("Numpy array shape: %s" % str(shape))
+            for i in np.arange(n_channels):
                 logging.info("windows array: non-zero elements at index %d:%d" %
-                             (i, np.argwhere(numpy_array[i, :] != 0).shape[0]))
-            np.savez(file=os.path.join(outDir, 'windows'),
-                     data=numpy_array,
-                     labels=labs)
+                             (i, nonzero_cnt[i]))
+        elif npz_mode and window_table:
+            save_window_table(os.path.join(outDir, 'windows.npz'),
+                              table, pairs, padding_len, labs, batch_size)
+            logging.info("Window table shape: %s" % str(table.shape))
+        elif npz_mode:
+            logging.info('Creating np.arrays win1 and win2...')
+            shape = (len(labs), win_pair_len, n_channels)
+            save_windows_by_chunk(os.path.join(outDir, 'windows.npz'),
+                                  window_batches(), shape, dtype, labs)
+            logging.info("Numpy array shape: %s" % str(shape))
+            for i in np.arange(n_channels):
+                logging.info("windows array: non-zero elements at index %d:%d" %
+                             (i, nonzero_cnt[i]))
+        del X, table
+        os.remove(table_file)
+    if fused:
+        aln.close()
 
 
 def main():
@@ -162,6 +354,35 @@ def main():
                         type=int,
                         default=10,
                         help="Length of the padding in between windows")
+    parser.add_argument('-bs',
+                        '--batch_size',
+                        type=int,
+                        default=1000,
+                        help="Number of window pairs to keep in memory before writing them")
+    parser.add_argument('-wt',
+                        '--window_table',
+                        action='store_true',
+                        help="Save the table of unique windows and the pair indices instead of "
+                             "the window pairs")
+    parser.add_argument('-nr',
+                        '--negative_ratio',
+                        type=float,
+                        default=1.0,
+                        help="Number of negatives to sample per positive (training mode)")
+    parser.add_argument('-sd',
+                        '--seed',
+                        type=int,
+                        default=1,
+                        help="Seed for sampling the negatives (training mode)")
+    parser.add_argument('-f',
+                        '--fused',
+                        action='store_true',
+                        help="Add the window channels from the BAM file while creating the "
+                             "windows and save windows_en.npz, add_win_channels.py is not needed")
+    parser.add_argument('-sw',
+                        '--sweep',
+                        action='store_true',
+                        help="Fused mode: assign reads to windows with one sweep per batch")
     args = parser.parse_args()
     output_dir = args.outputpath
     os.makedirs(output_dir, exist_ok=True)
@@ -179,7 +400,14 @@ def main():
                 label_file_path=args.labels,
                 mode=args.mode,
                 npz_mode=args.save_npz,
-                padding_len=args.padding)
+                padding_len=args.padding,
+                batch_size=args.batch_size,
+                window_table=args.window_table,
+                negative_ratio=args.negative_ratio,
+                seed=args.seed,
+                bam=args.bam,
+                fused=args.fused,
+                sweep=args.sweep)
     logging.info('Elapsed time create_windows = %f seconds' % (time() - t0))
 
 
@@ -0,0 +1,403 @@
+import gzip
+import json
+import logging
+import threading
+from collections import Counter
+from time import time
+
+import numpy as np
+import pysam
+import tensorflow as tf
+from tensorflow.keras.utils import Sequence
+
+from add_win_channels import (add_win_pair_channels, apply_channel_updates,
+                              get_channel_table, get_channels)
+from create_window_pairs import load_chr_array, unfold_win_id
+from functions import get_class_label, get_mapclasses
+
+
+class WindowSource:
+    '''
+    Array-like source of linked-windows computed on the fly from the chromosome arrays and the BAM
+    file, without materializing windows.npz and windows_en.npz. Each thread reading from the source
+    opens its own chromosome arrays and BAM file.
+    '''
+
+    def __init__(self, carrays_dir, chrom_list, bam, win_ids, win, padding_len, channels=None):
+        '''
+        :param carrays_dir: directory with the chr_array folder
+        :param chrom_list: list of chromosomes
+        :param bam: BAM file used for the window specific channels
+        :param win_ids: list of window pair IDs
+        :param win: window size
+        :param padding_len: length of the padding in between windows
+        :param channels: indices of the channels to keep, all channels if None
+        '''
+        self.carrays_dir = carrays_dir
+        self.chrom_list = chrom_list
+        self.bam = bam
+        self.win_ids = list(win_ids)
+        self.win = win if win % 2 == 0 else win + 1
+        self.win_hlen = int(self.win / 2)
+        self.padding_len = padding_len
+        self.ch = get_channels()
+        self.ch_table = get_channel_table(self.ch)
+        self._local = threading.local()
+        chr_array, aln = self._handles()
+        self.n_carray_channels = chr_array[chrom_list[0]].shape[1]
+        n_channels = self.n_carray_channels + len(self.ch)
+        self.channels = np.arange(n_channels) if channels is None else np.asarray(channels)
+        self.dtype = np.dtype(np.float32)
+        self.shape = (len(self.win_ids), 2 * self.win + padding_len, len(self.channels))
+        self.ndim = len(self.shape)
+
+    def _handles(self):
+        if not hasattr(self._local, 'aln'):
+            self._local.chr_array = load_chr_array(self.carrays_dir, self.chrom_list)
+            self._local.aln = pysam.AlignmentFile(self.bam, 'rb')
+        return self._local.chr_array, self._local.aln
+
+    def get_window_pair(self, win_id):
+        chr_array, aln = self._handles()
+        chr1, pos1, chr2, pos2, strand_info = unfold_win_id(win_id)
+        second_start = self.win + self.padding_len
+        X = np.zeros(shape=(self.shape[1], self.n_carray_channels), dtype=self.dtype)
+        X[:self.win] = chr_array[chr1][pos1 - self.win_hlen:pos1 + self.win_hlen, :]
+        X[second_start:] = chr_array[chr2][pos2 - self.win_hlen:pos2 + self.win_hlen, :]
+        X_enh = np.zeros(shape=(1, self.shape[1], len(self.ch)), dtype=np.int8)
+        updates = add_win_pair_channels(aln, [], 0, chr1, pos1, chr2, pos2,
+                                        self.win, self.padding_len)
+        X_enh = apply_channel_updates(X_enh, self.ch_table, updates)
+        return np.concatenate((X, X_enh[0]), axis=1)[:, self.channels]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        idx = np.arange(self.shape[0])[idx]
+        if idx.ndim == 0:
+            return self.get_window_pair(self.win_ids[idx])
+        X = np.zeros(shape=(len(idx),) + self.shape[1:], dtype=self.dtype)
+        for j, i in enumerate(idx):
+            X[j] = self.get_window_pair(self.win_ids[i])
+        return X
+
+
+class WindowSubset:
+    '''
+    Array-like view of a subset of the windows of an array-like, windows are only read on access
+    '''
+
+    def __init__(self, X, indices):
+        indices = np.asarray(indices)
+        if isinstance(X, WindowSubset):
+            # index the underlying windows directly instead of chaining views
+            X, indices = X.X, X.indices[indices]
+        self.X = X
+        self.indices = indices
+        self.dtype = X.dtype
+        self.shape = (len(self.indices),) + tuple(X.shape[1:])
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        return self.X[self.indices[idx]]
+
+
+def get_indices(idx, n):
+    '''
+    :param idx: integer, slice or array of indices
+    :param n: length of the indexed axis
+    :return: array of indices
+    '''
+    if isinstance(idx, slice):
+        return np.arange(*idx.indices(n))
+    return np.asarray(idx)
+
+
+class ConcatWindows:
+    '''
+    Array-like concatenation of array-likes of windows (e.g. memory-mapped window files of several
+    samples), windows are only read on access
+    '''
+
+    def __init__(self, arrays):
+        self.arrays = list(arrays)
+        assert len({a.shape[1:] for a in self.arrays}) == 1, 'Windows of different shapes'
+        self.offsets = np.cumsum([0] + [a.shape[0] for a in self.arrays])
+        self.dtype = np.result_type(*[a.dtype for a in self.arrays])
+        self.shape = (int(self.offsets[-1]),) + tuple(self.arrays[0].shape[1:])
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, tuple):
+            X = self[idx[0]]
+            return X[(slice(None),) + idx[1:]] if np.ndim(X) == self.ndim else X[idx[1:]]
+        idx = get_indices(idx, self.shape[0]).astype(np.int64)
+        # negative indices count from the end, as for numpy arrays
+        out_of_range = (idx >= self.shape[0]) | (idx < -self.shape[0])
+        if np.any(out_of_range):
+            raise IndexError('index {} is out of bounds for windows of size {}'.format(
+                idx[out_of_range].flat[0], self.shape[0]))
+        idx = np.where(idx < 0, idx + self.shape[0], idx)
+        if idx.ndim == 0:
+            i = int(idx)
+            shard = np.searchsorted(self.offsets, i, side='right') - 1
+            return np.asarray(self.arrays[shard][i - self.offsets[shard]])
+        X = np.zeros(shape=(len(idx),) + self.shape[1:], dtype=self.dtype)
+        shards = np.searchsorted(self.offsets, idx, side='right') - 1
+        for shard in np.unique(shards):
+            sel = np.flatnonzero(shards == shard)
+            local_idx = idx[sel] - self.offsets[shard]
+            # read the windows in file order
+            order = np.argsort(local_idx, kind='stable')
+            X[sel[order]] = self.arrays[shard][local_idx[order]]
+        return X
+
+
+def get_data_format(X):
+    '''
+    :param X: array-like of windows
+    :return: description of the array-like and of the arrays it reads the windows from
+    '''
+    if isinstance(X, WindowSubset):
+        return 'WindowSubset(' + get_data_format(X.X) + ')'
+    if isinstance(X, ConcatWindows):
+        return 'ConcatWindows(' + ','.join(sorted({get_data_format(a) for a in X.arrays})) + ')'
+    return type(X).__name__
+
+
+class InputTimer:
+    '''
+    Thread-safe accumulator of the time spent by the readers of the input pipeline reading batches of
+    windows, summed over the parallel readers, and time at which the last batch was dequeued by the
+    training step
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.time = 0.0
+            self.batches = 0
+            self.dequeued = 0.0
+
+    def add(self, seconds):
+        with self.lock:
+            self.time += seconds
+            self.batches += 1
+
+    def dequeue(self):
+        with self.lock:
+            self.dequeued = time()
+
+
+class EpochIndices:
+    '''
+    Indices of the windows of every epoch, shuffled with a seed derived from the epoch number so that
+    the window order of any epoch can be drawn again when the training is resumed
+    '''
+
+    def __init__(self, indices, shuffle=True, seed=0):
+        '''
+        :param indices: indices of the windows
+        :param shuffle: shuffle the windows at every epoch
+        :param seed: seed of the window order
+        '''
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.shuffle = shuffle
+        self.seed = seed
+        # epoch of the next call and number of windows of that epoch to skip
+        self.epoch = 0
+        self.skip = 0
+
+    def __len__(self):
+        return len(self.indices)
+
+    def get_epoch(self, epoch):
+        if not self.shuffle:
+            return self.indices
+        return np.random.default_rng((self.seed, epoch)).permutation(self.indices)
+
+    def __call__(self):
+        indices = self.get_epoch(self.epoch)[self.skip:]
+        self.epoch += 1
+        self.skip = 0
+        return indices
+
+
+class NegativeSampler(EpochIndices):
+    '''
+    Indices of the windows of an epoch: all the positive windows and a fresh sample of negative
+    windows, negative_ratio negative windows per positive window. The negative windows are drawn
+    without replacement from a shuffled pool, reshuffled once all of them have been drawn, so that
+    all the negative windows are used over the epochs.
+    '''
+
+    def __init__(self, positives, negatives, negative_ratio, seed=0):
+        '''
+        :param positives: indices of the positive windows
+        :param negatives: indices of the negative windows
+        :param negative_ratio: number of negative windows per positive window in an epoch
+        :param seed: seed of the random generator
+        '''
+        super().__init__(positives, shuffle=True, seed=seed)
+        self.negatives = np.asarray(negatives, dtype=np.int64)
+        self.n_negatives = min(len(self.negatives),
+                               int(round(negative_ratio * len(self.indices))))
+        self.pool_cycle = None
+
+    def __len__(self):
+        return len(self.indices) + self.n_negatives
+
+    def get_pool(self, cycle):
+        if cycle != self.pool_cycle:
+            self.pool = np.random.default_rng((self.seed, cycle, 1)).permutation(self.negatives)
+            self.pool_cycle = cycle
+        return self.pool
+
+    def sample_negatives(self, epoch):
+        samples = []
+        n = self.n_negatives
+        start = epoch * self.n_negatives
+        while n > 0:
+            cycle, offset = divmod(start, len(self.negatives))
+            samples.append(self.get_pool(cycle)[offset:offset + n])
+            start += len(samples[-1])
+            n -= len(samples[-1])
+        return np.concatenate(samples) if samples else np.array([], dtype=np.int64)
+
+    def get_epoch(self, epoch):
+        indices = np.concatenate((self.indices, self.sample_negatives(epoch)))
+        return np.random.default_rng((self.seed, epoch)).permutation(indices)
+
+
+def get_dataset(X, y_binary, indices, batch_size=32, shuffle=True, workers=4, prefetch=10,
+                timer=None):
+    '''
+    Streaming tf.data input pipeline over an array-like of windows. The window indices are shuffled
+    and batched, the windows of each batch are gathered from X by parallel calls and the next batches
+    are prefetched, so that only a few batches are held in memory.
+    :param X: array-like of windows
+    :param y_binary: one-hot encoded labels
+    :param indices: indices of the windows of X to use, or EpochIndices drawing the (shuffled)
+    indices of every epoch
+    :param batch_size: batch size
+    :param shuffle: shuffle the windows at every epoch
+    :param workers: number of batches gathered in parallel
+    :param prefetch: number of batches prepared in advance
+    :param timer: InputTimer recording the time spent reading the batches and the time at which
+    they are dequeued, optional
+    :return: tf.data.Dataset of (windows, labels) batches
+    '''
+    def gather(batch_idx):
+        t0 = time()
+        # read the windows in file order
+        batch_idx = np.sort(batch_idx)
+        batch = np.asarray(X[batch_idx], dtype=np.float32), \
+            np.asarray(y_binary[batch_idx], dtype=np.float32)
+        if timer is not None:
+            timer.add(time() - t0)
+        return batch
+
+    def set_shapes(X_batch, y_batch):
+        X_batch.set_shape((None,) + tuple(X.shape[1:]))
+        y_batch.set_shape((None, y_binary.shape[1]))
+        return X_batch, y_batch
+
+    if isinstance(indices, EpochIndices):
+        # the generator is called again at every epoch
+        def epoch_indices():
+            yield indices()
+
+        # output_types and output_shapes: output_signature requires TensorFlow >= 2.4
+        dataset = tf.data.Dataset.from_generator(
+            epoch_indices, output_types=tf.int64, output_shapes=(None,)).unbatch()
+    else:
+        indices = np.asarray(indices, dtype=np.int64)
+        dataset = tf.data.Dataset.from_tensor_slices(indices)
+        if shuffle:
+            dataset = dataset.shuffle(len(indices), reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(
+        lambda batch_idx: tf.numpy_function(gather, [batch_idx], (tf.float32, tf.float32)),
+        num_parallel_calls=workers)
+    dataset = dataset.map(set_shapes)
+    dataset = dataset.prefetch(prefetch)
+    if timer is not None:
+        def dequeue(y_batch):
+            timer.dequeue()
+            return y_batch
+
+        # after the prefetch: runs when the training step takes the batch
+        dataset = dataset.map(lambda X_batch, y_batch: (
+            X_batch, tf.numpy_function(dequeue, [y_batch], tf.float32)))
+        dataset = dataset.map(set_shapes)
+        options = tf.data.Options()
+        if hasattr(options.experimental_optimization, 'inject_prefetch'):
+            # no prefetch injected after the last map by recent TensorFlow versions
+            options.experimental_optimization.inject_prefetch = False
+        dataset = dataset.with_options(options)
+    return dataset
+
+
+class DataGenerator(Sequence):
+    '''
+    Generates batches of windows for Keras from an array-like of windows (np.ndarray, np.memmap,
+    LinkedWindows, WindowSource). Only the windows of the current batch are read.
+    '''
+
+    def __init__(self, X, y_binary, indices, batch_size=32, shuffle=True):
+        '''
+        :param X: array-like of windows
+        :param y_binary: one-hot encoded labels, None to generate only the windows (prediction)
+        :param indices: indices of the windows of X to use
+        :param batch_size: batch size
+        :param shuffle: shuffle the windows at the end of every epoch
+        '''
+        self.X = X
+        self.y_binary = y_binary
+        self.indices = np.array(indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / self.batch_size))
+
+    def __getitem__(self, index):
+        batch_idx = self.indices[index * self.batch_size:(index + 1) * self.batch_size]
+        X = np.asarray(self.X[batch_idx], dtype=np.float32)
+        if self.y_binary is None:
+            return X
+        return X, self.y_binary[batch_idx]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.indices)
+
+
+def get_data_from_labels(label_file, carrays_dir, chrom_list, bam, win, padding_len, channels, svtype):
+    '''
+    Same output as model_functions.get_data, with windows computed on the fly from the label file
+    :return: WindowSource, array of classes and array of window pair IDs
+    '''
+    logging.info('Loading labels from {}...'.format(label_file))
+    with gzip.GzipFile(label_file, 'r') as fin:
+        labels = json.loads(fin.read().decode('utf-8'))
+    mapclasses = get_mapclasses(svtype)
+    labels = {k: get_class_label(v, mapclasses) for k, v in labels.items()}
+    labels = {k: v for k, v in labels.items() if v in mapclasses.keys()}
+    logging.info(Counter(labels.values()))
+    X = WindowSource(carrays_dir, chrom_list, bam, labels.keys(), win, padding_len, channels)
+    logging.info(X.shape)
+    y = np.array([mapclasses[i] for i in labels.values()])
+    win_ids = np.array(list(labels.keys()))
+    return X, y, win_ids
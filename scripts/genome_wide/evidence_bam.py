@@ -0,0 +1,167 @@
+import argparse
+import logging
+import os
+from time import time
+
+import numpy as np
+import pysam
+
+from functions import has_suppl_aln, is_clipped, merge_regions
+
+
+def has_large_indels(read, min_indel_len):
+    '''
+    :param read: read object of the class pysam.AlignedSegment
+    :param min_indel_len: minimum length of the insertions (1) and deletions (2) to consider
+    :return: True if the CIGAR of the read has an insertion or a deletion of at least min_indel_len
+    '''
+    if read.cigartuples is not None:
+        for op, length in read.cigartuples:
+            if op in (1, 2) and length >= min_indel_len:
+                return True
+    return False
+
+
+def is_informative(read, min_indel_len):
+    '''
+    :param read: read object of the class pysam.AlignedSegment
+    :param min_indel_len: minimum length of the insertions and deletions to consider
+    :return: True if the read is clipped, split (SA tag), discordant or has a large indel
+    '''
+    if read.is_unmapped:
+        return False
+    if is_clipped(read) or has_suppl_aln(read) or has_large_indels(read, min_indel_len):
+        return True
+    if read.is_paired and (not read.is_proper_pair or read.mate_is_unmapped or
+                           read.reference_id != read.next_reference_id):
+        return True
+    return False
+
+
+def get_mate_key(read):
+    '''
+    :param read: read object of the class pysam.AlignedSegment
+    :return: key of the primary alignment of the mate: hash of the read name, mate position and
+    whether the mate is the first read of the pair
+    '''
+    return hash(read.query_name), read.next_reference_start, not read.is_read1
+
+
+def get_evidence_bam(ibam, chr_list, min_indel_len, outBam):
+    '''
+    Write the informative reads of the chromosomes in chr_list and their mates in an indexed BAM
+    file. The informative reads are written while scanning the BAM file, their mates are then
+    fetched only at the mate positions.
+    :param ibam: input BAM alignment file
+    :param chr_list: list of chromosomes to consider
+    :param min_indel_len: minimum length of the insertions and deletions to consider
+    :param outBam: output BAM file with the informative reads and their mates
+    :return: None
+    '''
+    bamfile = pysam.AlignmentFile(ibam, "rb")
+    # Keep the order of the BAM header
+    chr_list = sorted(chr_list, key=bamfile.get_tid)
+    unsortedBam = outBam + '.unsorted.bam'
+    # Log information every n_r reads
+    n_r = 10 ** 6
+    last_t = time()
+
+    # Mate keys of the informative reads by mate chromosome
+    mate_keys = {chrom: set() for chrom in chr_list}
+    n_written = 0
+    with pysam.AlignmentFile(unsortedBam, "wb", template=bamfile) as fout:
+        # Single pass over the BAM file: write the informative reads
+        for chrom in chr_list:
+            for i, read in enumerate(bamfile.fetch(chrom), start=1):
+                if not i % n_r:
+                    logging.info("%d alignments processed on Chr%s (%f alignments / s)" %
+                                 (i, chrom, n_r / (time() - last_t)))
+                    last_t = time()
+                if is_informative(read, min_indel_len):
+                    fout.write(read)
+                    n_written += 1
+                    # Unmapped mates are placed at the position of the read
+                    if read.is_paired and read.next_reference_name in mate_keys:
+                        mate_keys[read.next_reference_name].add(get_mate_key(read))
+            logging.info("Chr%s: %d informative alignments so far" % (chrom, n_written))
+
+        # Mate rescue: fetch only the positions of the mates not yet written
+        n_mates = 0
+        for chrom in chr_list:
+            keys = mate_keys[chrom]
+            positions = np.unique(np.array([pos for _, pos, _ in keys], dtype=np.int64))
+            regions = merge_regions(positions, positions + 1,
+                                    bamfile.get_reference_length(chrom))
+            for start, end in regions:
+                for read in bamfile.fetch(chrom, start, end):
+                    if read.is_secondary or read.is_supplementary or \
+                            is_informative(read, min_indel_len):
+                        continue
+                    key = (hash(read.query_name), read.reference_start, read.is_read1)
+                    if key in keys:
+                        # A read can overlap more than one region
+                        keys.discard(key)
+                        fout.write(read)
+                        n_mates += 1
+            logging.info("Chr%s: %d mates written so far" % (chrom, n_mates))
+    bamfile.close()
+
+    pysam.sort("-o", outBam, unsortedBam)
+    os.remove(unsortedBam)
+    pysam.index(outBam)
+    logging.info("%d alignments written to %s" % (n_written + n_mates, outBam))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Extract the informative reads and their mates')
+    parser.add_argument('-b',
+                        '--bam',
+                        type=str,
+                        default='../../data/test.bam',
+                        help="Specify input file (BAM)")
+    parser.add_argument('-c',
+                        '--chrlist',
+                        type=str,
+                        default='12,22',
+                        help="Comma separated list of chromosomes to consider")
+    parser.add_argument('-o',
+                        '--out',
+                        type=str,
+                        default='evidence.bam',
+                        help="Specify output BAM")
+    parser.add_argument('-i',
+                        '--min_indel_len',
+                        type=int,
+                        default=1,
+                        help='Minimum length of the insertions and deletions to consider')
+    parser.add_argument(
+        '-p',
+        '--outputpath',
+        type=str,
+        default='.',
+        help="Specify output path")
+    parser.add_argument('-l',
+                        '--logfile',
+                        default='evidence_bam.log',
+                        help='File in which to write logs.')
+    args = parser.parse_args()
+    cmd_name = 'evidence_bam'
+    output_dir = os.path.join(args.outputpath, cmd_name)
+    os.makedirs(output_dir, exist_ok=True)
+    logfilename = os.path.join(output_dir, args.logfile)
+    FORMAT = '%(asctime)s %(message)s'
+    logging.basicConfig(format=FORMAT,
+                        filename=logfilename,
+                        filemode='w',
+                        level=logging.INFO)
+    t0 = time()
+    get_evidence_bam(ibam=args.bam,
+                     chr_list=args.chrlist.split(','),
+                     min_indel_len=args.min_indel_len,
+                     outBam=os.path.join(output_dir, args.out))
+    logging.info('Time: evidence BAM on BAM %s: %f' % (args.bam, (time() - t0)))
+
+
+if __name__ == '__main__':
+    main()
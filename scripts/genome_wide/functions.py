@@ -1,7 +1,13 @@
 import gzip
+import io
 import json
 import logging
 import os
+import struct
+import tempfile
+import zipfile
+import zlib
+from array import array
 from itertools import groupby
 from statistics import mean, stdev
 
@@ -426,18 +432,631 @@ def load_all_clipped_read_positions(win_hlen, svtype, chr_dict, output_dir, clip
         return cpos_list_right, cpos_list_left
 
 
+class GroupedMedian:
+    '''
+    Collects (position, value) pairs in flat int32/float32 buffers, spilled to a temporary file in
+    chunks, and reduces them to the median value per position by sorting and segmenting.
+    '''
+    dtype = np.dtype([('pos', np.int32), ('val', np.float32)])
+
+    def __init__(self, chunk_size=2 ** 20):
+        '''
+        :param chunk_size: number of pairs kept in memory before spilling them to disk
+        '''
+        self.chunk_size = chunk_size
+        self.pos = array('i')
+        self.vals = array('f')
+        self.spill_file = None
+
+    def append(self, pos, val):
+        self.pos.append(pos)
+        self.vals.append(val)
+        if len(self.pos) >= self.chunk_size:
+            self.spill()
+
+    def spill(self):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile()
+        chunk = np.empty(len(self.pos), dtype=self.dtype)
+        chunk['pos'] = np.frombuffer(self.pos, dtype=np.intc)
+        chunk['val'] = np.frombuffer(self.vals, dtype=np.float32)
+        chunk.tofile(self.spill_file)
+        self.pos = array('i')
+        self.vals = array('f')
+
+    def __len__(self):
+        n_spilled = 0 if self.spill_file is None else self.spill_file.tell() // self.dtype.itemsize
+        return n_spilled + len(self.pos)
+
+    def median(self):
+        '''
+        :return: sorted unique positions and median value per position
+        '''
+        if self.spill_file is not None:
+            self.spill()
+            self.spill_file.seek(0)
+            data = np.fromfile(self.spill_file, dtype=self.dtype)
+            self.spill_file.close()
+            self.spill_file = None
+            pos, vals = data['pos'], data['val']
+        else:
+            pos = np.frombuffer(self.pos, dtype=np.intc).copy()
+            vals = np.frombuffer(self.vals, dtype=np.float32).copy()
+        self.pos = array('i')
+        self.vals = array('f')
+        order = np.lexsort((vals, pos))
+        pos, vals = pos[order], vals[order]
+        starts = np.flatnonzero(np.r_[True, pos[1:] != pos[:-1]]) if len(pos) > 0 \
+            else np.zeros(0, dtype=int)
+        counts = np.diff(np.r_[starts, len(pos)])
+        # lower and upper middle values of each segment, equal for odd counts
+        lower = vals[starts + (counts - 1) // 2].astype(np.float64)
+        upper = vals[starts + counts // 2].astype(np.float64)
+        return pos[starts], (lower + upper) / 2
+
+    def median_dict(self):
+        '''
+        :return: dictionary with positions as keys and median values as values
+        '''
+        pos, med = self.median()
+        return dict(zip(pos.tolist(), med.tolist()))
+
+
+def memmap_npz_array(npz_file, name, mode='r'):
+    '''
+    np.load ignores mmap_mode for npz files. Arrays written by np.savez are stored uncompressed in the
+    zip archive, therefore they can be memory-mapped at their offset in the file.
+    :param npz_file: npz file
+    :param name: name of the array in the npz file
+    :param mode: memmap mode
+    :return: np.memmap of the array, None if the array is compressed or contains Python objects
+    '''
+    with zipfile.ZipFile(npz_file) as zf:
+        info = zf.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(npz_file, 'rb') as f:
+        # local file header: 30 bytes followed by file name and extra field
+        f.seek(info.header_offset)
+        name_len, extra_len = struct.unpack('<HH', f.read(30)[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if dtype.hasobject:
+        return None
+    return np.memmap(npz_file, dtype=dtype, mode=mode, offset=offset,
+                     shape=shape, order='F' if fortran_order else 'C')
+
+
+def merge_regions(starts, ends, chr_len):
+    '''
+    :param starts: array of region start positions
+    :param ends: array of region end positions (excluded)
+    :param chr_len: chromosome length
+    :return: array of the sorted, merged regions [start, end) with shape [n_regions, 2]
+    '''
+    starts = np.clip(np.asarray(starts, dtype=np.int64), 0, chr_len)
+    ends = np.clip(np.asarray(ends, dtype=np.int64), 0, chr_len)
+    if len(starts) == 0:
+        return np.zeros(shape=(0, 2), dtype=np.int64)
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    ends = np.maximum.accumulate(ends[order])
+    # a region starts where it does not overlap nor touch the previous ones
+    first = np.flatnonzero(np.r_[True, starts[1:] > ends[:-1]])
+    last = np.r_[first[1:] - 1, len(starts) - 1]
+    return np.stack([starts[first], ends[last]], axis=1)
+
+
+def get_candidate_regions(split_reads_file, chrom, win, chr_len):
+    '''
+    :param split_reads_file: output of split_reads.py
+    :param chrom: chromosome to consider
+    :param win: window size
+    :param chr_len: chromosome length
+    :return: array of the merged regions [start, end) covering the windows centered on the candidate
+    breakpoints of the chromosome, with shape [n_regions, 2]
+    '''
+    win_hlen = int((win + win % 2) / 2)
+    with gzip.GzipFile(split_reads_file, 'rb') as fin:
+        total_reads_coord_min_support = json.loads(fin.read().decode('utf-8'))[2]
+    positions = np.array([pos
+                          for coords in total_reads_coord_min_support.values()
+                          for chr1, pos1, chr2, pos2, strand_info in coords
+                          for c, pos in ((chr1, pos1), (chr2, pos2)) if c == chrom],
+                         dtype=np.int64)
+    return merge_regions(positions - win_hlen, positions + win_hlen, chr_len)
+
+
+def get_region_offsets(regions):
+    '''
+    :param regions: array of regions [start, end) with shape [n_regions, 2]
+    :return: row of the first position of each region in the concatenation of the regions, followed by
+    the total number of rows
+    '''
+    return np.r_[0, np.cumsum(regions[:, 1] - regions[:, 0])].astype(np.int64)
+
+
+def get_region_positions(regions):
+    '''
+    :param regions: array of regions [start, end) with shape [n_regions, 2]
+    :return: array of the positions of the concatenation of the regions
+    '''
+    if len(regions) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate([np.arange(start, end) for start, end in regions])
+
+
+def get_region_rows(regions, positions):
+    '''
+    :param regions: array of sorted, non-overlapping regions [start, end) with shape [n_regions, 2]
+    :param positions: array of positions
+    :return: row of each position in the concatenation of the regions, -1 for the positions outside
+    the regions
+    '''
+    positions = np.asarray(positions, dtype=np.int64)
+    if len(regions) == 0:
+        return np.full(positions.shape, -1, dtype=np.int64)
+    offsets = get_region_offsets(regions)
+    i = np.maximum(np.searchsorted(regions[:, 0], positions, side='right') - 1, 0)
+    inside = (positions >= regions[i, 0]) & (positions < regions[i, 1])
+    return np.where(inside, offsets[i] + positions - regions[i, 0], -1)
+
+
+class RegionArray:
+    '''
+    Array-like view in chromosome coordinates of per-base channels stored only for a set of regions,
+    as written by chr_array.py in candidate mode. Positions outside the regions read as zeros: the
+    slices not fully covered by the regions are counted in uncovered, the first one is logged.
+    '''
+
+    def __init__(self, data, regions, chr_len):
+        '''
+        :param data: array of the concatenated regions with shape [n_rows, n_channels]
+        :param regions: array of sorted, non-overlapping regions [start, end) with shape [n_regions, 2]
+        :param chr_len: chromosome length
+        '''
+        self.data = data
+        self.regions = np.asarray(regions, dtype=np.int64)
+        self.offsets = get_region_offsets(self.regions)
+        assert self.offsets[-1] == data.shape[0]
+        self.dtype = data.dtype
+        self.shape = (int(chr_len),) + tuple(data.shape[1:])
+        self.ndim = len(self.shape)
+        self.uncovered = 0
+
+    def __len__(self):
+        return self.shape[0]
+
+    def get_region(self, start, stop):
+        '''
+        :param start: first position
+        :param stop: last position (excluded)
+        :return: index of the region covering the positions [start, stop), -1 if they are not fully
+        covered by a region
+        '''
+        r = np.searchsorted(self.regions[:, 1], start, side='right')
+        if r < len(self.regions) and self.regions[r, 0] <= start and stop <= self.regions[r, 1]:
+            return int(r)
+        return -1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, tuple):
+            return self[idx[0]][(slice(None),) + idx[1:]]
+        start, stop, step = idx.indices(self.shape[0])
+        assert step == 1, 'Only contiguous slices are supported'
+        if stop > start and self.get_region(start, stop) < 0:
+            if self.uncovered == 0:
+                logging.warning('Positions %d-%d not covered by the candidate regions read as zeros' %
+                                (start, stop))
+            self.uncovered += 1
+        X = np.zeros(shape=(max(stop - start, 0),) + self.shape[1:], dtype=self.dtype)
+        first = np.searchsorted(self.regions[:, 1], start, side='right')
+        last = np.searchsorted(self.regions[:, 0], stop, side='left')
+        for r in range(first, last):
+            region_start, region_end = self.regions[r]
+            s, e = max(start, region_start), min(stop, region_end)
+            row = self.offsets[r] + s - region_start
+            X[s - start:e - start] = self.data[row:row + e - s]
+        return X
+
+
+def save_sparse_channels(events_file, n_rows, events, dense_channels, n_channels,
+                         block_size=2 ** 16):
+    '''
+    Save the event channels of a chromosome array as sorted COO (position, channel, value) with a
+    block index: the entries of the positions [i * block_size, (i + 1) * block_size) are
+    block_index[i]:block_index[i + 1] and their positions are stored relative to the block start.
+    :param events_file: output file (npz)
+    :param n_rows: number of positions of the chromosome array
+    :param events: list of (positions, channel, values) tuples, one per event channel
+    :param dense_channels: indices of the channels stored in the carray
+    :param n_channels: number of channels of the chromosome array
+    :param block_size: number of positions per block, at most 2 ** 16
+    :return: None
+    '''
+    assert block_size <= 2 ** 16, 'Block relative positions are stored as uint16'
+    pos = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                         [np.asarray(p, dtype=np.int64) for p, c, v in events])
+    ch = np.concatenate([np.zeros(0, dtype=np.uint8)] +
+                        [np.full(len(p), c, dtype=np.uint8) for p, c, v in events])
+    val = np.concatenate([np.zeros(0, dtype=np.float32)] +
+                         [np.asarray(v, dtype=np.float32) for p, c, v in events])
+    nonzero = val != 0
+    pos, ch, val = pos[nonzero], ch[nonzero], val[nonzero]
+    order = np.lexsort((ch, pos))
+    pos, ch, val = pos[order], ch[order], val[order]
+    n_blocks = -(-n_rows // block_size)
+    block_index = np.searchsorted(pos, np.arange(n_blocks + 1, dtype=np.int64) * block_size)
+    np.savez(events_file,
+             pos=(pos % block_size).astype(np.uint16),
+             ch=ch,
+             val=val,
+             block_index=block_index.astype(np.int64),
+             block_size=block_size,
+             dense_channels=np.asarray(dense_channels, dtype=np.int64),
+             n_channels=n_channels)
+
+
+class SparseChrArray:
+    '''
+    Array-like chromosome array with the dense channels (coverage, SNVs, reference) stored as a chunked
+    dense array and the event channels as sorted COO with a block index, as written by chr_array.py in
+    sparse mode. Only the positions of the requested slice are densified.
+    '''
+
+    def __init__(self, dense, events_file):
+        '''
+        :param dense: array of the dense channels with shape [n_positions, n_dense_channels]
+        :param events_file: event channels saved by save_sparse_channels
+        '''
+        self.dense = dense
+        with np.load(events_file) as npzfile:
+            self.block_index = npzfile['block_index']
+            self.block_size = int(npzfile['block_size'])
+            self.dense_channels = npzfile['dense_channels']
+            n_channels = int(npzfile['n_channels'])
+            arrays = {k: memmap_npz_array(events_file, k) for k in ('pos', 'ch', 'val')}
+            self.pos, self.ch, self.val = [npzfile[k] if arrays[k] is None else arrays[k]
+                                           for k in ('pos', 'ch', 'val')]
+        self.dtype = np.result_type(dense.dtype, np.float32)
+        self.shape = (dense.shape[0], n_channels)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, tuple):
+            return self[idx[0]][(slice(None),) + idx[1:]]
+        start, stop, step = idx.indices(self.shape[0])
+        assert step == 1, 'Only contiguous slices are supported'
+        X = np.zeros(shape=(max(stop - start, 0), self.shape[1]), dtype=self.dtype)
+        if stop <= start:
+            return X
+        X[:, self.dense_channels] = self.dense[start:stop]
+        first_block, last_block = start // self.block_size, -(-stop // self.block_size)
+        lo = self.block_index[first_block]
+        hi = self.block_index[last_block]
+        # positions relative to the start of their block
+        block_starts = np.arange(first_block, last_block, dtype=np.int64) * self.block_size
+        pos = np.asarray(self.pos[lo:hi], dtype=np.int64) + np.repeat(
+            block_starts, np.diff(self.block_index[first_block:last_block + 1]))
+        keep = (pos >= start) & (pos < stop)
+        X[pos[keep] - start, np.asarray(self.ch[lo:hi])[keep]] = np.asarray(self.val[lo:hi])[keep]
+        return X
+
+
+class LinkedWindows:
+    '''
+    Array-like view of linked-windows composed on the fly from a table of unique breakpoint windows.
+    Window pairs sharing a breakpoint refer to the same row of the table.
+    '''
+
+    def __init__(self, table, pairs, padding_len):
+        '''
+        :param table: array of unique windows with shape [n_windows, window_size, n_channels]
+        :param pairs: array of indices into table with shape [n_pairs, 2]
+        :param padding_len: length of the zero padding in between the two windows
+        '''
+        self.table = table
+        self.pairs = np.asarray(pairs)
+        self.padding_len = int(padding_len)
+        self.win_len = table.shape[1]
+        self.dtype = table.dtype
+        self.shape = (self.pairs.shape[0], 2 * self.win_len + self.padding_len, table.shape[2])
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, tuple):
+            X = self[idx[0]]
+            if isinstance(idx[0], slice) or np.ndim(idx[0]) > 0:
+                return X[(slice(None),) + idx[1:]]
+            return X[idx[1:]]
+        pairs = self.pairs[idx]
+        if pairs.ndim == 1:
+            return self[[idx]][0]
+        X = np.zeros(shape=(pairs.shape[0],) + self.shape[1:], dtype=self.dtype)
+        if pairs.shape[0] > 0:
+            X[:, :self.win_len] = self.table[pairs[:, 0]]
+            X[:, self.win_len + self.padding_len:] = self.table[pairs[:, 1]]
+        return X
+
+    def __array__(self, dtype=None, copy=None):
+        X = self[:]
+        return X if dtype is None else X.astype(dtype)
+
+
 def load_windows(win_file):
-    npzfile = np.load(win_file, allow_pickle=True, mmap_mode='r')
-    X = npzfile['data']
+    npzfile = np.load(win_file, allow_pickle=True)
+    if 'table' in npzfile.files:
+        table = memmap_npz_array(win_file, 'table')
+        if table is None:
+            table = npzfile['table']
+        X = LinkedWindows(table, npzfile['pairs'], npzfile['padding'])
+    else:
+        X = memmap_npz_array(win_file, 'data')
+        if X is None:
+            X = npzfile['data']
     y = npzfile['labels']
     y = y.item()
     return X, y
 
 
+def get_mapclasses(svtype):
+    '''
+    :param svtype: SV type, or comma separated list of SV types for a multi-class model
+    :return: dictionary mapping the window labels to the classes, one class per SV type and one for
+    the windows without SV (labelled no<svtype>, noSV in the multi-class model)
+    '''
+    svtypes = list(dict.fromkeys(svtype.split(',')))
+    if len(svtypes) == 1:
+        return {svtype: 0, 'no' + svtype: 1}
+    mapclasses = {sv: i for i, sv in enumerate(svtypes)}
+    mapclasses['noSV'] = len(svtypes)
+    return mapclasses
+
+
+def get_negative_class(mapclasses):
+    '''
+    :param mapclasses: dictionary returned by get_mapclasses
+    :return: class of the windows without SV
+    '''
+    return [i for k, i in mapclasses.items() if k.startswith('no')][0]
+
+
+def get_class_label(label, mapclasses):
+    '''
+    :param label: window label (e.g. DEL, noDEL)
+    :param mapclasses: dictionary returned by get_mapclasses
+    :return: the label in the classes of mapclasses (noDEL is noSV in the multi-class model)
+    '''
+    if label.startswith('no') and 'noSV' in mapclasses and label[2:] in mapclasses:
+        return 'noSV'
+    return label
+
+
 def save_windows(X, y, win_file):
     np.savez(file=win_file, data=X, labels=y)
 
 
+def write_npy_by_chunk(zf, name, chunks, shape, dtype):
+    '''
+    Write an array as an uncompressed member of an open npz archive, one chunk at a time.
+    :param zf: zipfile.ZipFile opened for writing
+    :param name: name of the array in the npz file
+    :param chunks: iterable of arrays, concatenated along the first axis they should match shape
+    :param shape: shape of the full array
+    :param dtype: dtype of the full array
+    :return: None
+    '''
+    dtype = np.dtype(dtype)
+    header = {'descr': np.lib.format.dtype_to_descr(dtype),
+              'fortran_order': False,
+              'shape': tuple(shape)}
+    n_written = 0
+    with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+        np.lib.format.write_array_header_2_0(f, header)
+        for chunk in chunks:
+            chunk = np.ascontiguousarray(chunk, dtype=dtype)
+            assert chunk.shape[1:] == tuple(shape[1:])
+            f.write(chunk.tobytes())
+            n_written += chunk.shape[0]
+    assert n_written == shape[0], \
+        '{}: {} rows written, {} expected'.format(name, n_written, shape[0])
+
+
+def save_windows_by_chunk(win_file, chunks, shape, dtype, y):
+    '''
+    Write windows in the same npz layout as save_windows, without holding the whole array in memory.
+    :param win_file: output npz file
+    :param chunks: iterable of arrays of windows, concatenated along the first axis they should
+    match shape
+    :param shape: shape of the full array of windows
+    :param dtype: dtype of the full array of windows
+    :param y: dictionary of labels
+    :return: None
+    '''
+    with zipfile.ZipFile(win_file, mode='w', compression=zipfile.ZIP_STORED,
+                         allowZip64=True) as zf:
+        write_npy_by_chunk(zf, 'data', chunks, shape, dtype)
+        with zf.open('labels.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, np.asanyarray(y), allow_pickle=True)
+
+
+# ZIP64 records of the npz files written by preallocate_windows, see the ZIP file format
+# specification (APPNOTE.TXT): local file header, central directory header, ZIP64 end of central
+# directory record and locator, end of central directory record
+ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+ZIP_CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+ZIP64_END_RECORD = struct.Struct('<4sQ2H2L4Q')
+ZIP64_END_LOCATOR = struct.Struct('<4sLQL')
+ZIP_END_RECORD = struct.Struct('<4s4H2LH')
+ZIP64_VERSION = 45
+ZIP_MAX = 0xFFFFFFFF
+
+
+def write_zip64_member(f, name, data, size):
+    '''
+    Write an uncompressed member of a ZIP64 archive at the current position of f: local file header,
+    data and an unwritten hole up to size bytes
+    :param f: file opened for writing
+    :param name: name of the member
+    :param data: first bytes of the member
+    :param size: size of the member
+    :return: offset of the local file header, CRC-32 of the member (0 if there is a hole)
+    '''
+    offset = f.tell()
+    crc = zlib.crc32(data) if len(data) == size else 0
+    name = name.encode('utf-8')
+    # ZIP64 extended information: uncompressed and compressed sizes
+    extra = struct.pack('<2H2Q', 1, 16, size, size)
+    f.write(ZIP_LOCAL_HEADER.pack(b'PK\x03\x04', ZIP64_VERSION, 0, 0, zipfile.ZIP_STORED, 0,
+                                  (1 << 5) | 1, crc, ZIP_MAX, ZIP_MAX, len(name), len(extra)))
+    f.write(name)
+    f.write(extra)
+    f.write(data)
+    f.seek(size - len(data), os.SEEK_CUR)
+    return offset, crc
+
+
+def write_zip64_directory(f, members):
+    '''
+    Write the central directory of a ZIP64 archive at the current position of f
+    :param f: file opened for writing
+    :param members: list of (name, size, offset of the local file header, CRC-32) of the members
+    :return: None
+    '''
+    cd_offset = f.tell()
+    for name, size, offset, crc in members:
+        name = name.encode('utf-8')
+        # ZIP64 extended information: uncompressed and compressed sizes, local file header offset
+        extra = struct.pack('<2H3Q', 1, 24, size, size, offset)
+        f.write(ZIP_CENTRAL_HEADER.pack(b'PK\x01\x02', ZIP64_VERSION, 3, ZIP64_VERSION, 0, 0,
+                                        zipfile.ZIP_STORED, 0, (1 << 5) | 1, crc, ZIP_MAX,
+                                        ZIP_MAX, len(name), len(extra), 0, 0, 0, 0o644 << 16,
+                                        ZIP_MAX))
+        f.write(name)
+        f.write(extra)
+    cd_end = f.tell()
+    f.write(ZIP64_END_RECORD.pack(b'PK\x06\x06', ZIP64_END_RECORD.size - 12, ZIP64_VERSION,
+                                  ZIP64_VERSION, 0, 0, len(members), len(members),
+                                  cd_end - cd_offset, cd_offset))
+    f.write(ZIP64_END_LOCATOR.pack(b'PK\x06\x07', 0, cd_end, 1))
+    f.write(ZIP_END_RECORD.pack(b'PK\x05\x06', 0, 0, len(members), len(members), ZIP_MAX,
+                                ZIP_MAX, 0))
+
+
+def preallocate_windows(win_file, shape, dtype, y):
+    '''
+    Write windows in the same npz layout as save_windows, leaving the array of windows unwritten: it
+    is filled in place with memmap_npz_array(win_file, 'data', mode='r+'), then update_npz_crc is
+    called. The unwritten array is a hole of the file, it does not take disk space until it is
+    written on file systems supporting sparse files.
+    :param win_file: output npz file
+    :param shape: shape of the array of windows
+    :param dtype: dtype of the array of windows
+    :param y: dictionary of labels
+    :return: None
+    '''
+    dtype = np.dtype(dtype)
+    header = io.BytesIO()
+    np.lib.format.write_array_header_2_0(header, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                  'fortran_order': False,
+                                                  'shape': tuple(shape)})
+    header = header.getvalue()
+    labels = io.BytesIO()
+    np.lib.format.write_array(labels, np.asanyarray(y), allow_pickle=True)
+    labels = labels.getvalue()
+    data_size = len(header) + int(np.prod(shape)) * dtype.itemsize
+    with open(win_file, 'wb') as f:
+        data_offset, data_crc = write_zip64_member(f, 'data.npy', header, data_size)
+        labels_offset, labels_crc = write_zip64_member(f, 'labels.npy', labels, len(labels))
+        write_zip64_directory(f, [('data.npy', data_size, data_offset, data_crc),
+                                  ('labels.npy', len(labels), labels_offset, labels_crc)])
+
+
+def get_central_directory_offset(f):
+    '''
+    :param f: ZIP file without archive comment, opened for reading
+    :return: offset of the central directory
+    '''
+    f.seek(-ZIP_END_RECORD.size, os.SEEK_END)
+    cd_offset = ZIP_END_RECORD.unpack(f.read(ZIP_END_RECORD.size))[6]
+    if cd_offset == ZIP_MAX:
+        f.seek(-ZIP_END_RECORD.size - ZIP64_END_LOCATOR.size, os.SEEK_END)
+        f.seek(ZIP64_END_LOCATOR.unpack(f.read(ZIP64_END_LOCATOR.size))[2])
+        cd_offset = ZIP64_END_RECORD.unpack(f.read(ZIP64_END_RECORD.size))[9]
+    return cd_offset
+
+
+def update_npz_crc(npz_file, name):
+    '''
+    Update the CRC-32 of an uncompressed array of a npz file written in place, in the local file
+    header and in the central directory
+    :param npz_file: npz file
+    :param name: name of the array in the npz file
+    :return: None
+    '''
+    with zipfile.ZipFile(npz_file) as zf:
+        info = zf.getinfo(name + '.npy')
+    with open(npz_file, 'r+b') as f:
+        f.seek(info.header_offset)
+        name_len, extra_len = ZIP_LOCAL_HEADER.unpack(f.read(ZIP_LOCAL_HEADER.size))[10:12]
+        f.seek(info.header_offset + ZIP_LOCAL_HEADER.size + name_len + extra_len)
+        crc = 0
+        remaining = info.file_size
+        while remaining > 0:
+            chunk = f.read(min(remaining, 2 ** 24))
+            assert len(chunk) > 0, 'Truncated member {} of {}'.format(info.filename, npz_file)
+            crc = zlib.crc32(chunk, crc)
+            remaining -= len(chunk)
+        crc = struct.pack('<L', crc)
+        # CRC-32 at offset 14 of the local file header and 16 of the central directory header
+        f.seek(info.header_offset + 14)
+        f.write(crc)
+        f.seek(get_central_directory_offset(f))
+        while True:
+            entry = ZIP_CENTRAL_HEADER.unpack(f.read(ZIP_CENTRAL_HEADER.size))
+            assert entry[0] == b'PK\x01\x02', 'Central directory entry of {} not found'.format(name)
+            name_len, extra_len, comment_len = entry[12:15]
+            if f.read(name_len).decode('utf-8') == info.filename:
+                f.seek(-name_len - ZIP_CENTRAL_HEADER.size + 16, os.SEEK_CUR)
+                f.write(crc)
+                break
+            f.seek(extra_len + comment_len, os.SEEK_CUR)
+
+
+def save_window_table(win_file, table, pairs, padding_len, y, batch_size):
+    '''
+    Write the table of unique windows and the pair indices instead of the linked-windows.
+    load_windows returns a LinkedWindows view for these files.
+    :param win_file: output npz file
+    :param table: array of unique windows
+    :param pairs: array of indices into table with shape [n_pairs, 2]
+    :param padding_len: length of the zero padding in between the two windows
+    :param y: dictionary of labels
+    :param batch_size: number of windows to write at once
+    :return: None
+    '''
+    chunks = (table[i:i + batch_size] for i in range(0, table.shape[0], batch_size))
+    with zipfile.ZipFile(win_file, mode='w', compression=zipfile.ZIP_STORED,
+                         allowZip64=True) as zf:
+        write_npy_by_chunk(zf, 'table', chunks, table.shape, table.dtype)
+        for name, arr in (('pairs', np.asarray(pairs, dtype=np.int64)),
+                          ('padding', np.asarray(padding_len, dtype=np.int64)),
+                          ('labels', np.asanyarray(y))):
+            with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, arr, allow_pickle=True)
+
+
 def get_chr_dict(fasta_file):
     d = dict()
     with pysam.FastaFile(filename=fasta_file, filepath_index=fasta_file + '.fai') as fa:
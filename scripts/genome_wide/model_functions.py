@@ -1,7 +1,11 @@
+import json
 import logging
 import os
+import platform
+import resource
 from collections import Counter
 from itertools import cycle
+from time import time
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -9,6 +13,11 @@ import pandas as pd
 # from mcfly import modelgen, find_architecture
 from sklearn.metrics import (average_precision_score, f1_score,
                              precision_recall_curve)
+import tensorflow as tf
+from tensorflow.keras.callbacks import Callback
+
+from data_generator import ConcatWindows, DataGenerator, WindowSubset
+from functions import get_class_label, get_mapclasses, get_negative_class, load_windows
 
 
 def unfold_win_id(win_id):
@@ -67,36 +76,276 @@ def unfold_win_id(win_id):
 #     return history, best_model
 
 def get_data(windows_list, npz_mode, svtype):
-
-    def filter_labels(X, y, win_ids):
-        keep = [i for i, v in enumerate(y) if v in [svtype, 'no' + svtype]]
-        X = X[np.array(keep)]
-        y = [y[i] for i in keep]
-        win_ids = [win_ids[i] for i in keep]
-        return X, y, win_ids
-
+    '''
+    Load the windows of svtype and no<svtype> of a list of window files. The windows are not copied:
+    the window files are memory-mapped and the windows with other labels are left out by indexing.
+    With a comma separated list of SV types, the windows of the window files of all the SV types are
+    loaded once for a multi-class model, a window pair labelled with several SV types keeps the first
+    SV type of the list.
+    :param windows_list: list of window files
+    :param npz_mode: window files in npz format
+    :param svtype: SV type, or comma separated list of SV types
+    :return: array-like of windows, array of classes and array of window pair IDs
+    '''
     X = []
     y = []
     win_ids = []
 
     for t in windows_list:
         logging.info('Loading data from {}...'.format(t))
-        npzfile = np.load(t, allow_pickle=True)
-        X.extend(npzfile['data'])
-        labels = npzfile['labels']
-        labels = labels.item()
+        # windows are memory-mapped, they are read batch by batch
+        X_t, labels = load_windows(t)
+        X.append(X_t)
         y.extend(labels.values())
         win_ids.extend(labels.keys())
         logging.info('Data from {} loaded'.format(t))
-    X = np.stack(X, axis=0)
+    X = ConcatWindows(X)
     logging.info(X.shape)
     logging.info(Counter(y))
-    mapclasses = {svtype: 0, 'no' + svtype: 1}
-    y = np.array([mapclasses[i] for i in y])
+    mapclasses = get_mapclasses(svtype)
+    y = np.array([get_class_label(label, mapclasses) for label in y])
     win_ids = np.array(win_ids)
+    keep = np.flatnonzero(np.isin(y, list(mapclasses.keys())))
+    if 'noSV' in mapclasses:
+        # the window files of the SV types share most window pairs: keep one window per window pair,
+        # labelled with its SV type if any. A window pair labelled with several SV types keeps the
+        # first SV type of svtype (lowest class, noSV is the last class).
+        classes = np.array([mapclasses[i] for i in y[keep]])
+        sort = np.lexsort((classes, win_ids[keep]))
+        order, classes = keep[sort], classes[sort]
+        _, first = np.unique(win_ids[order], return_index=True)
+        # conflicts: window pairs with more than one distinct SV type
+        sv = classes != mapclasses['noSV']
+        sv_ids, sv_classes = win_ids[order][sv], classes[sv]
+        distinct = np.ones(len(sv_ids), dtype=bool)
+        distinct[1:] = (sv_ids[1:] != sv_ids[:-1]) | (sv_classes[1:] != sv_classes[:-1])
+        distinct_ids = sv_ids[distinct]
+        conflicts = np.unique(distinct_ids[1:][distinct_ids[1:] == distinct_ids[:-1]])
+        if len(conflicts) > 0:
+            logging.warning('%d window pairs labelled with several SV types, labelled with the '
+                            'first SV type of %s (e.g. %s)' % (len(conflicts), svtype, conflicts[0]))
+        keep = np.sort(order[first])
+        logging.info(Counter(y[keep]))
+    if len(keep) < len(y):
+        logging.info('%d windows left out' % (len(y) - len(keep)))
+        X, y, win_ids = WindowSubset(X, keep), y[keep], win_ids[keep]
+    y = np.array([mapclasses[i] for i in y])
     return X, y, win_ids
 
 
+class ThroughputLogger(Callback):
+    '''
+    Keras callback recording the training throughput per epoch: time per epoch, time per step,
+    windows per second, time the training steps wait for the input pipeline, time spent by the
+    readers of the input pipeline and peak RSS. The report is written in JSON at the end of the
+    training.
+    '''
+
+    def __init__(self, outfile, windows_per_epoch, batch_size, timer=None, workers=1,
+                 data_format=None):
+        '''
+        :param outfile: output JSON file
+        :param windows_per_epoch: number of training windows per epoch
+        :param batch_size: batch size, the last batch of an epoch holds the remaining windows
+        :param timer: InputTimer of the input pipeline, None to not record the input times
+        :param workers: number of batches read in parallel by the input pipeline
+        :param data_format: description of the training windows (e.g. array-like class)
+        '''
+        super().__init__()
+        self.outfile = outfile
+        self.windows_per_epoch = windows_per_epoch
+        self.batch_size = batch_size
+        # number of windows of the next epoch already trained before the training was resumed
+        self.skip = 0
+        self.timer = timer
+        self.workers = workers
+        self.data_format = data_format
+        self.epochs = []
+
+    def on_train_begin(self, logs=None):
+        self.t_train = time()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        if self.timer is not None:
+            self.timer.reset()
+        self.step_times = []
+        self.input_wait = 0.0
+        self.windows = 0
+        self.windows_left = self.windows_per_epoch - self.skip
+        self.skip = 0
+        self.t_epoch = time()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.t_step = time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step_times.append(time() - self.t_step)
+        if self.timer is not None and self.timer.dequeued > self.t_step:
+            # from the start of the step until the batch is taken from the prefetch buffer
+            self.input_wait += self.timer.dequeued - self.t_step
+        batch_size = min(self.batch_size, self.windows_left)
+        self.windows += batch_size
+        self.windows_left -= batch_size
+
+    def on_epoch_end(self, epoch, logs=None):
+        # training windows only, the validation is included in the epoch time
+        epoch_time = time() - self.t_epoch
+        step_times = np.array(self.step_times)
+        stats = {
+            'epoch': epoch + 1,
+            'epoch_time': epoch_time,
+            'steps': len(step_times),
+            'windows': self.windows,
+            'step_time_mean': float(step_times.mean()) if len(step_times) else 0.0,
+            'step_time_max': float(step_times.max()) if len(step_times) else 0.0,
+            'windows_per_second': self.windows / max(step_times.sum(), 1e-9),
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        }
+        if self.timer is not None:
+            stats['input_wait'] = self.input_wait
+            stats['input_wait_fraction'] = self.input_wait / max(step_times.sum(), 1e-9)
+            # summed over the parallel readers
+            stats['reader_time'] = self.timer.time
+            stats['reader_batches'] = self.timer.batches
+        self.epochs.append(stats)
+        logging.info('Epoch %d: %f s, %f windows/s' %
+                     (epoch + 1, epoch_time, stats['windows_per_second']))
+
+    def on_train_end(self, logs=None):
+        report = {
+            'host': platform.node(),
+            'cpu_count': os.cpu_count(),
+            'data_format': self.data_format,
+            'windows_per_epoch': self.windows_per_epoch,
+            'input_workers': self.workers,
+            'train_time': time() - self.t_train,
+            'epochs': self.epochs
+        }
+        with open(self.outfile, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+class TrainingCheckpoint(Callback):
+    '''
+    Keras callback saving a checkpoint of the training every every_steps steps and at the end of
+    every epoch: weights, optimizer state, epoch, steps done in the epoch, seed of the window order
+    and state of the early stopping and best model callbacks, including the best weights restored by
+    the early stopping, so that the training can be resumed where it stopped.
+    '''
+
+    def __init__(self, model, checkpoint_dir, every_steps, seed, callbacks=()):
+        '''
+        :param model: compiled model
+        :param checkpoint_dir: directory of the checkpoints
+        :param every_steps: number of steps between checkpoints, 0 to save only at the end of epochs
+        :param seed: seed of the window order
+        :param callbacks: callbacks with a state to save (EarlyStopping, ModelCheckpoint)
+        '''
+        super().__init__()
+        self.every_steps = every_steps
+        self.seed = seed
+        self.state_callbacks = callbacks
+        self.state_fn = os.path.join(checkpoint_dir, 'state.json')
+        self.best_weights_fn = os.path.join(checkpoint_dir, 'best_weights.npz')
+        # best weights of the callbacks, as saved in best_weights_fn
+        self.best_weights = [None for _ in callbacks]
+        self.checkpoint = tf.train.Checkpoint(model=model, optimizer=model.optimizer)
+        self.manager = tf.train.CheckpointManager(self.checkpoint, checkpoint_dir, max_to_keep=2)
+        self.state = {'epoch': 0, 'step': 0, 'done': False,
+                      'callbacks': [{} for _ in callbacks]}
+
+    def restore(self):
+        '''
+        Restore the weights and the optimizer state of the last checkpoint
+        :return: training state of the last checkpoint, None if there is no checkpoint
+        '''
+        if not os.path.exists(self.state_fn):
+            return None
+        with open(self.state_fn) as f:
+            self.state = json.load(f)
+        assert self.state['seed'] == self.seed, 'Checkpoint saved with another window order'
+        self.checkpoint.restore(self.state['checkpoint'])
+        if os.path.exists(self.best_weights_fn):
+            with np.load(self.best_weights_fn) as best_weights:
+                for i, c_state in enumerate(self.state['callbacks']):
+                    if 'best_weights' in c_state:
+                        self.best_weights[i] = [best_weights['{}_{}'.format(i, j)]
+                                                for j in range(c_state['best_weights'])]
+        logging.info('Training resumed from %s: epoch %d, step %d' %
+                     (self.state['checkpoint'], self.state['epoch'] + 1, self.state['step']))
+        return self.state
+
+    def save(self):
+        self.state['checkpoint'] = self.manager.save()
+        self.state['seed'] = self.seed
+        self.state['callbacks'] = [
+            {k: float(getattr(c, k)) for k in ('wait', 'best') if hasattr(c, k)}
+            for c in self.state_callbacks]
+        for c, c_state in zip(self.state_callbacks, self.state['callbacks']):
+            if getattr(c, 'best_weights', None) is not None:
+                c_state['best_weights'] = len(c.best_weights)
+        self.save_best_weights()
+        # the state file always refers to a complete checkpoint
+        with open(self.state_fn + '.tmp', 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(self.state_fn + '.tmp', self.state_fn)
+
+    def save_best_weights(self):
+        '''
+        Save the best weights of the callbacks (EarlyStopping with restore_best_weights) when they
+        changed since the last checkpoint
+        '''
+        best_weights = [getattr(c, 'best_weights', None) for c in self.state_callbacks]
+        if all(w is v for w, v in zip(best_weights, self.best_weights)):
+            return
+        arrays = {'{}_{}'.format(i, j): w for i, weights in enumerate(best_weights)
+                  if weights is not None for j, w in enumerate(weights)}
+        with open(self.best_weights_fn + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(self.best_weights_fn + '.tmp', self.best_weights_fn)
+        self.best_weights = best_weights
+
+    def on_train_begin(self, logs=None):
+        # after the callbacks have reset their state
+        for i, (c, c_state) in enumerate(zip(self.state_callbacks, self.state['callbacks'])):
+            for k, v in c_state.items():
+                if k == 'best_weights':
+                    c.best_weights = self.best_weights[i]
+                else:
+                    setattr(c, k, int(v) if k == 'wait' else v)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        if epoch != self.state['epoch']:
+            self.state['epoch'] = epoch
+            self.state['step'] = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.state['step'] += 1
+        if self.every_steps > 0 and self.state['step'] % self.every_steps == 0:
+            self.save()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.state['epoch'] = epoch + 1
+        self.state['step'] = 0
+        self.save()
+
+    def on_train_end(self, logs=None):
+        self.state['done'] = True
+        self.save()
+
+
+def predict_windows(model, X, batch_size=1000, workers=1):
+    '''
+    Predict windows held in memory or read batch by batch from an array-like (memmap, LinkedWindows,
+    WindowSource)
+    '''
+    if type(X) is np.ndarray:
+        return model.predict(X, batch_size=batch_size, verbose=False)
+    return model.predict(DataGenerator(X, None, np.arange(X.shape[0]), batch_size, shuffle=False),
+                         workers=workers, verbose=False)
+
+
 def evaluate_model(model, X_test, ytest_binary, win_ids_test,
                    results, mapclasses, output_dir, svtype):
 
@@ -109,7 +358,7 @@ def evaluate_model(model, X_test, ytest_binary, win_ids_test,
 
         for prob, p, r, w in zip(probs, predicted, y_index, win_ids_test):
             if class_labels[p] != class_labels[r]:
-                sv_score = prob[0]
+                sv_score = 1 - prob[no_sv]
                 chr1, pos1, chr2, pos2, strand_info = unfold_win_id(w)
                 # print('{0}_{1}:{2}_{3}'.format(chr1, pos1, chr2, pos2))
                 lines.append('\t'.join([
@@ -132,16 +381,14 @@ def evaluate_model(model, X_test, ytest_binary, win_ids_test,
 
     def write_correct_predictions(probs, predicted, y_index, win_ids_test,
                                   class_labels, svtype):
-        outdir = os.path.join(output_dir, 'predictions')
-        os.makedirs(outdir, exist_ok=True)
-        outfile = os.path.join(outdir, 'correct.bedpe')
-        lines = []
+        # one file per SV type with the multi-class model
+        lines = {}
         j = 1
         for prob, p, r, w in zip(probs, predicted, y_index, win_ids_test):
-            if class_labels[p] == svtype:
-                sv_score = prob[0]
+            if p != no_sv:
+                sv_score = prob[p]
                 chr1, pos1, chr2, pos2, strand_info = unfold_win_id(w)
-                lines.append('\t'.join([
+                lines.setdefault(class_labels[p], []).append('\t'.join([
                     str(chr1),
                     str(pos1),
                     str(int(pos1) + 1),
@@ -156,15 +403,21 @@ def evaluate_model(model, X_test, ytest_binary, win_ids_test,
                 ]) + '\n')
                 j += 1
 
-        with open(outfile, 'w') as f:
-            # use set to make lines unique
-            for ln in lines:
-                f.write(ln)
+        for sv in [k for k in class_labels if k != class_labels[no_sv]]:
+            outdir = os.path.join(output_dir, 'predictions')
+            if len(class_labels) > 2:
+                outdir = os.path.join(outdir, sv)
+            os.makedirs(outdir, exist_ok=True)
+            with open(os.path.join(outdir, 'correct.bedpe'), 'w') as f:
+                for ln in lines.get(sv, []):
+                    f.write(ln)
 
     dict_sorted = sorted(mapclasses.items(), key=lambda x: x[1])
     class_labels = [i[0] for i in dict_sorted]
+    # class of the windows without SV
+    no_sv = get_negative_class(mapclasses)
     n_classes = ytest_binary.shape[1]
-    probs = model.predict(X_test, batch_size=1000, verbose=False)
+    probs = predict_windows(model, X_test, batch_size=1000)
     # columns are predicted, rows are truth
     predicted = probs.argmax(axis=1)
     y_index = ytest_binary.argmax(axis=1)
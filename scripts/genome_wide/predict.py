@@ -6,6 +6,7 @@ import pandas as pd
 from tensorflow.keras.models import load_model
 from tensorflow.keras.utils import to_categorical
 
+from functions import get_mapclasses
 from model_functions import evaluate_model, get_data
 
 
@@ -61,7 +62,8 @@ def main():
                         '--svtype',
                         type=str,
                         default='DEL',
-                        help="Specify SV type")
+                        help="Specify SV type, or comma separated list of SV types for a multi-class "
+                             "model")
     parser.add_argument('-fe',
                         '--encode_blacklist',
                         type=str,
@@ -83,7 +85,7 @@ def main():
                         default='results',
                         help="Output folder")
     args = parser.parse_args()
-    mapclasses = {args.svtype: 0, 'no' + args.svtype: 1}
+    mapclasses = get_mapclasses(args.svtype)
     # Parameters
     global params
     params = {
@@ -11,7 +11,17 @@ import twobitreader as twobit
 from functions import *
 
 
-def get_snvs(ibam, itwobit, chrName, max_coverage, outFile):
+def get_snvs(ibam, itwobit, chrName, max_coverage, outFile, regions=None):
+    '''
+    :param ibam: input BAM alignment file
+    :param itwobit: reference genome (2bit)
+    :param chrName: chromosome name to consider
+    :param max_coverage: consider only positions with coverage less than max_coverage
+    :param outFile: output file for the SNV array
+    :param regions: array of regions [start, end) to consider, the whole chromosome if None. The
+    SNV array then holds the concatenation of the regions.
+    :return: None
+    '''
 
     def get_snv_number(query_seq_list, reference_base):
 
@@ -27,41 +37,47 @@ def get_snvs(ibam, itwobit, chrName, max_coverage, outFile):
     header_dict = bamfile.header
     # Get the chromosome length from the header
     chrLen = [i['LN'] for i in header_dict['SQ'] if i['SN'] == chrName][0]
-    # Fetch reads over the entire chromosome between positions [0, chrLen]
-    start_pos = 0
-    stop_pos = chrLen
+    # Pileup over the regions, by default the entire chromosome between positions [0, chrLen]
+    if regions is None:
+        regions = [(0, chrLen)]
     reference_sequence = twobit.TwoBitFile(itwobit)
     snv_list = ['BQ', 'SNV', 'MAPQ']
-    snv_array = np.zeros(shape=(stop_pos, len(snv_list)), dtype=np.float32)
+    snv_array = np.zeros(shape=(sum(end - start for start, end in regions), len(snv_list)),
+                         dtype=np.float32)
     snv_dict = {v: n for n, v in enumerate(snv_list)}
-
-    for pileupcolumn in bamfile.pileup(chrName,
-                                       start_pos,
-                                       stop_pos,
-                                       stepper='all'):
-        if 0 < pileupcolumn.nsegments < max_coverage and start_pos <= pileupcolumn.pos <= stop_pos:
-            quals = pileupcolumn.get_query_qualities()
-            if len(quals) > 0:
-                snv_array[pileupcolumn.pos, snv_dict['BQ']] = np.median(
-                    quals)
-            quals = pileupcolumn.get_mapping_qualities()
-            if len(quals) > 0:
-                snv_array[pileupcolumn.pos, snv_dict['MAPQ']] = np.median(
-                    quals)
-            try:
-                query_seq_list = pileupcolumn.get_query_sequences()
-                snv_number = get_snv_number(
-                    query_seq_list,
-                    reference_sequence[chrName][pileupcolumn.pos])
-                snv_array[pileupcolumn.pos, snv_dict['SNV']] = snv_number / pileupcolumn.nsegments \
-                    if pileupcolumn.nsegments != 0 else 0
-
-            except AssertionError as error:
-                # Output expected AssertionErrors.
-                logging.info(error)
-                logging.info("Position %s:%d has %d nsegments" % (
-                    str(chrName), pileupcolumn.pos, pileupcolumn.nsegments))
-                continue
+    offset = 0
+
+    for start_pos, stop_pos in regions:
+        for pileupcolumn in bamfile.pileup(chrName,
+                                           start_pos,
+                                           stop_pos,
+                                           stepper='all',
+                                           truncate=True):
+            row = offset + pileupcolumn.pos - start_pos
+            if 0 < pileupcolumn.nsegments < max_coverage:
+                quals = pileupcolumn.get_query_qualities()
+                if len(quals) > 0:
+                    snv_array[row, snv_dict['BQ']] = np.median(
+                        quals)
+                quals = pileupcolumn.get_mapping_qualities()
+                if len(quals) > 0:
+                    snv_array[row, snv_dict['MAPQ']] = np.median(
+                        quals)
+                try:
+                    query_seq_list = pileupcolumn.get_query_sequences()
+                    snv_number = get_snv_number(
+                        query_seq_list,
+                        reference_sequence[chrName][pileupcolumn.pos])
+                    snv_array[row, snv_dict['SNV']] = snv_number / pileupcolumn.nsegments \
+                        if pileupcolumn.nsegments != 0 else 0
+
+                except AssertionError as error:
+                    # Output expected AssertionErrors.
+                    logging.info(error)
+                    logging.info("Position %s:%d has %d nsegments" % (
+                        str(chrName), pileupcolumn.pos, pileupcolumn.nsegments))
+                    continue
+        offset += stop_pos - start_pos
 
     for i in np.arange(snv_array.shape[1]):
         logging.info("snv array %s: non-zero elements at index %d:%d" %
@@ -108,6 +124,12 @@ def main():
                         type=int,
                         default=1000,
                         help='Consider only regions with coverage less than max_coverage to speed up the processing')
+    parser.add_argument('-cw',
+                        '--candidate_window',
+                        type=int,
+                        default=0,
+                        help='If > 0, consider only the windows of this size centered on the '
+                             'candidate breakpoints found by split_reads.py')
     args = parser.parse_args()
     cmd_name = 'snv'
     output_dir = os.path.join(args.outputpath, cmd_name)
@@ -121,11 +143,21 @@ def main():
                         level=logging.INFO)
 
     t0 = time()
+    regions = None
+    if args.candidate_window > 0:
+        with pysam.AlignmentFile(args.bam, 'rb') as bam:
+            chr_len = bam.get_reference_length(args.chr)
+        regions = get_candidate_regions(
+            os.path.join(args.outputpath, 'split_reads', 'split_reads.json.gz'),
+            args.chr, args.candidate_window, chr_len)
+        logging.info('%d candidate regions covering %d positions' %
+                     (len(regions), (regions[:, 1] - regions[:, 0]).sum()))
     get_snvs(ibam=args.bam,
              itwobit=args.twobit,
              chrName=args.chr,
              max_coverage=args.max_coverage,
-             outFile=output_file)
+             outFile=output_file,
+             regions=regions)
     logging.info('Time: SNVs on BAM %s and Chr %s: %f' %
                  (args.bam, args.chr, (time() - t0)))
 
@@ -3,9 +3,11 @@ import gzip
 import json
 import logging
 import os
+from array import array
 from collections import Counter, defaultdict
 from time import time
 
+import numpy as np
 import pysam
 from cigar import Cigar
 
@@ -14,26 +16,60 @@ from functions import *
 strand_str = {True: '-', False: '+'}
 
 
-def append_coord(split_pos_coord, chr1, pos1, chr2, pos2, strand_info):
-    if chr1 == chr2:
-        if pos2 < pos1:
-            split_pos_coord.append((chr2, pos2, chr1, pos1, strand_info))
-        else:
-            split_pos_coord.append((chr1, pos1, chr2, pos2, strand_info))
-    elif chr2 < chr1:
-        split_pos_coord.append((chr2, pos2, chr1, pos1, strand_info))
-    elif chr2 > chr1:
-        split_pos_coord.append((chr1, pos1, chr2, pos2, strand_info))
+strand_code = {'+': 0, '-': 1}
+strand_str_by_code = ['+', '-']
+
+
+def append_coord(split_pos_coord, chr_code, chr1, pos1, chr2, pos2, strand_info):
+    '''
+    Append a pair of breakpoints, sorted by chromosome name and position, to a buffer of 64-bit keys.
+    Each breakpoint is encoded as chromosome code << 33 | position << 1 | strand, where the strand
+    is the one of strand_info at the same index.
+    :param split_pos_coord: array('Q') of breakpoint keys, two per pair
+    :param chr_code: dictionary of chromosome codes, in the order of the chromosome names
+    :return: split_pos_coord
+    '''
+    bp1 = chr_code[chr1] << 32 | pos1
+    bp2 = chr_code[chr2] << 32 | pos2
+    if bp2 < bp1:
+        bp1, bp2 = bp2, bp1
+    split_pos_coord.append(bp1 << 1 | strand_code[strand_info[0]])
+    split_pos_coord.append(bp2 << 1 | strand_code[strand_info[1]])
     return split_pos_coord
 
 
+def get_unique_coord(split_pos_coord):
+    '''
+    :param split_pos_coord: array('Q') of breakpoint keys as filled by append_coord
+    :return: array of unique pairs of breakpoint keys with shape [n_pairs, 2]
+    '''
+    keys = np.frombuffer(split_pos_coord, dtype=np.uint64).reshape(-1, 2)
+    return np.unique(keys, axis=0)
+
+
+def decode_coord(keys, chr_names):
+    '''
+    :param keys: array of pairs of breakpoint keys
+    :param chr_names: chromosome names by code
+    :return: list of (chr1, pos1, chr2, pos2, strand_info) tuples
+    '''
+    chr_idx = (keys >> np.uint64(33)).tolist()
+    pos = ((keys >> np.uint64(1)) & np.uint64(2 ** 32 - 1)).tolist()
+    strand = (keys & np.uint64(1)).tolist()
+    return [(chr_names[c1], p1, chr_names[c2], p2, strand_str_by_code[s1] + strand_str_by_code[s2])
+            for (c1, c2), (p1, p2), (s1, s2) in zip(chr_idx, pos, strand)]
+
+
 def get_split_read_positions(ibam, chr_list, min_mapq, min_sr_support, outFile, outBedpe):
     # List to store the split read positions
     split_pos_coord = dict()
     sv_type_list = ['INDEL_INS', 'INDEL_DEL',
                     'DEL', 'INS', 'INV', 'DUP', 'CTX', 'ND']
     for k in sv_type_list:
-        split_pos_coord[k] = []
+        split_pos_coord[k] = array('Q')
+    # Chromosome codes follow the order of the chromosome names
+    chr_names = sorted(chr_list)
+    chr_code = {chrom: i for i, chrom in enumerate(chr_names)}
 
     # Load the BAM file
     bamfile = pysam.AlignmentFile(ibam, "rb")
@@ -50,7 +86,7 @@ def get_split_read_positions(ibam, chr_list, min_mapq, min_sr_support, outFile,
         split_read_distance[chrom] = dict()
         for split_direction in ['left_F', 'left_R', 'right_F', 'right_R', 'both_F', 'both_R']:
             split_reads[chrom][split_direction] = defaultdict(int)
-            split_read_distance[chrom][split_direction] = defaultdict(list)
+            split_read_distance[chrom][split_direction] = GroupedMedian()
 
     clipped_pos_dict = dict()
     split_pos = dict()
@@ -59,7 +95,8 @@ def get_split_read_positions(ibam, chr_list, min_mapq, min_sr_support, outFile,
     positions_with_min_support = dict()
 
     for k in ['right', 'left', 'both']:
-        clipped_pos_dict[k] = defaultdict(list, {k: [] for k in chr_list})
+        # clipped positions as 32-bit integers
+        clipped_pos_dict[k] = {k: array('i') for k in chr_list}
         split_pos[k] = defaultdict(list, {k: [] for k in chr_list})
         split_pos_cnt[k] = dict.fromkeys(chr_list)
         total_reads_cnt[k] = dict.fromkeys(chr_list)
@@ -75,12 +112,13 @@ def get_split_read_positions(ibam, chr_list, min_mapq, min_sr_support, outFile,
                          (i, n_r / (time() - last_t)))
             last_t = time()
 
-        if is_left_clipped(read):
-            clipped_pos_dict['left'][read.reference_name].append(
-                read.reference_start + 1)
-        elif is_right_clipped(read):
-            clipped_pos_dict['right'][read.reference_name].append(
-                read.reference_end)
+        if read.reference_name in chr_list:
+            if is_left_clipped(read):
+                clipped_pos_dict['left'][read.reference_name].append(
+                    read.reference_start + 1)
+            elif is_right_clipped(read):
+                clipped_pos_dict['right'][read.reference_name].append(
+                    read.reference_end)
 
         if not read.is_unmapped and read.mapping_quality >= min_mapq and \
                 read.reference_name in chr_list:
@@ -91,7 +129,7 @@ def get_split_read_positions(ibam, chr_list, min_mapq, min_sr_support, outFile,
                 for pos in ins:
                     n_indels += 1
                     split_pos_coord['INDEL_INS'] = append_coord(
-                        split_pos_coord['INDEL_INS'], read.reference_name, pos,
+                        split_pos_coord['INDEL_INS'], chr_code, read.reference_name, pos,
                         read.reference_name, pos + 1, '+-')
                 for start, end in zip(dels_start, dels_end):
                     n_indels += 1
@@ -100,7 +138,7 @@ def get_split_read_positions(ibam, chr_list, min_mapq, min_sr_support, outFile,
                     if del_size > max_cigar_del:
                         max_cigar_del = del_size
                     split_pos_coord['INDEL_DEL'] = append_coord(
-                        split_pos_coord['INDEL_DEL'], read.reference_name, start,
+                        split_pos_coord['INDEL_DEL'], chr_code, read.reference_name, start,
                         read.reference_name, end, '+-')
 
             if read.has_tag('SA'):
@@ -166,6 +204,7 @@ def get_split_read_positions(ibam, chr_list, min_mapq, min_sr_support, outFile,
                             strand_info = strand_str[read.is_reverse]+strand_SA
 
                         split_pos_coord[sv_type] = append_coord(split_pos_coord[sv_type],
+                                                                chr_code,
                                                                 read.reference_name,
                                                                 clipped_pos,
                                                                 chr_SA,
@@ -175,36 +214,37 @@ def get_split_read_positions(ibam, chr_list, min_mapq, min_sr_support, outFile,
                         split_reads[read.reference_name][clipped_ch][clipped_pos] += 1
                         split_pos[clipped_string][read.reference_name].append(
                             clipped_pos)
-                        split_read_distance[read.reference_name][clipped_ch][clipped_pos].append(
-                            dist)
+                        split_read_distance[read.reference_name][clipped_ch].append(
+                            clipped_pos, dist)
     bamfile.close()
 
     # Look for INS positions:
     for chrom in chr_list:
         for k in ['right', 'left']:
-            clipped_pos_dict_cnt = Counter(clipped_pos_dict[k][chrom])
-            clipped_pos_dict[k][chrom] = {
-                int(key) for key, val in clipped_pos_dict_cnt.items() if val >= 3}
+            # sorted clipped positions with at least 3 clipped reads
+            clipped_pos, clipped_pos_cnt = np.unique(
+                np.frombuffer(clipped_pos_dict[k][chrom], dtype=np.intc), return_counts=True)
+            clipped_pos_dict[k][chrom] = clipped_pos[clipped_pos_cnt >= 3]
 
     # based on artificial INS
     for chrom in chr_list:
-        for p in clipped_pos_dict['right'][chrom]:
-            # is the right clipped position close to the left clipped position of a neighboring read?
-            if len(set(range(p - 1, p + 1, 1)) and clipped_pos_dict['left'][chrom]) > 0:
-                split_pos_coord['INS'] = append_coord(
-                    split_pos_coord['INS'], chrom, p, chrom, p + 1, '+-')
-        for p in clipped_pos_dict['left'][chrom]:
-            # is the right clipped position close to the left clipped position of a neighboring read?
-            if len(set(range(p - 1, p + 1, 1)) and clipped_pos_dict['right'][chrom]) > 0:
+        for k, k_other in [('right', 'left'), ('left', 'right')]:
+            clipped_pos = clipped_pos_dict[k][chrom]
+            other_pos = clipped_pos_dict[k_other][chrom]
+            # is the clipped position close (p - 1 or p) to the opposite clipped position of a
+            # neighboring read?
+            has_neighbour = np.searchsorted(other_pos, clipped_pos, side='right') > \
+                np.searchsorted(other_pos, clipped_pos - 1, side='left')
+            for p in clipped_pos[has_neighbour].tolist():
                 split_pos_coord['INS'] = append_coord(
-                    split_pos_coord['INS'], chrom, p, chrom, p + 1, '+-')
+                    split_pos_coord['INS'], chr_code, chrom, p, chrom, p + 1, '+-')
     # Count the number of split reads per position
     for chrom in chr_list:
         for k in ['right', 'left']:
             split_pos_cnt[k][chrom] = Counter(split_pos[k][chrom])
 
     for k in split_pos_coord.keys():
-        split_pos_coord[k] = set(split_pos_coord[k])
+        split_pos_coord[k] = get_unique_coord(split_pos_coord[k])
 
     logging.info('Largest CIGAR "D" DEL={}'.format(max_cigar_del))
     logging.info('INDELs={}, split_reads={}, discordant_reads={}'.format(
@@ -223,10 +263,7 @@ def get_split_read_positions(ibam, chr_list, min_mapq, min_sr_support, outFile,
         for k in ['right', 'left']:
             total_reads_cnt[k][chrom] = Counter(split_pos[k][chrom])
 
-    total_reads_coord = dict.fromkeys(split_pos_coord.keys())
-    for k in total_reads_coord.keys():
-        total_reads_coord[k] = list(set(
-            split_pos_coord[k]))  # | discordant_reads_coord))
+    total_reads_coord = split_pos_coord
 
     for chrom in chr_list:
         for k in ['right', 'left']:
@@ -240,27 +277,33 @@ def get_split_read_positions(ibam, chr_list, min_mapq, min_sr_support, outFile,
     for k in total_reads_coord.keys():
         logging.info("Number of unique pair of total positions %s: %d" %
                      (k, len(total_reads_coord[k])))
-    positions_with_min_support_set = dict.fromkeys(chr_list)
-
-    for chrom in chr_list:
-        positions_with_min_support_set[chrom] = set(
-            positions_with_min_support['left'][chrom] +
-            positions_with_min_support['right'][chrom])
+    # Breakpoints with min support, encoded as the breakpoint keys without strand
+    positions_with_min_support_keys = np.unique(np.array(
+        [chr_code[chrom] << 32 | p for chrom in chr_list
+         for p in positions_with_min_support['left'][chrom] +
+         positions_with_min_support['right'][chrom]], dtype=np.uint64))
     total_reads_coord_min_support = dict.fromkeys(total_reads_coord.keys())
 
     for k in total_reads_coord_min_support.keys():
         if k == 'INS':
             # INS positions are not based on split positions
-            total_reads_coord_min_support[k] = total_reads_coord[k]
+            keys = total_reads_coord[k]
         else:
-            total_reads_coord_min_support[k] = [
-                (chr1, pos1, chr2, pos2, strand_info)
-                for chr1, pos1, chr2, pos2, strand_info in total_reads_coord[k]
-                if pos1 in positions_with_min_support_set[chr1] or pos2 in positions_with_min_support_set[chr2]]
+            bp = total_reads_coord[k] >> np.uint64(1)
+            keys = total_reads_coord[k][
+                np.isin(bp[:, 0], positions_with_min_support_keys) |
+                np.isin(bp[:, 1], positions_with_min_support_keys)]
+        total_reads_coord_min_support[k] = decode_coord(keys, chr_names)
     for k in total_reads_coord_min_support.keys():
         logging.info("Number of total pairs of %s positions with min support: %d" % (
             k, len(total_reads_coord_min_support[k])))
 
+    # Median split read distance per position
+    for chrom in chr_list:
+        for split_direction in split_read_distance[chrom].keys():
+            split_read_distance[chrom][split_direction] = \
+                split_read_distance[chrom][split_direction].median_dict()
+
     data = (positions_with_min_support['left'],
             positions_with_min_support['right'], total_reads_coord_min_support,
             split_reads, split_read_distance)
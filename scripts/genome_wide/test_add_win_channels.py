@@ -0,0 +1,66 @@
+import numpy as np
+import pysam
+
+from add_win_channels import get_channel_table, get_channels, get_win_channels
+
+
+def write_bam(bam_file, n_pairs=300, chr_len=5000, seed=1):
+    '''
+    Write a coordinate sorted and indexed BAM file with read pairs, clipped reads and read pairs
+    with an unmapped mate, placed at the position of the mapped read or 300 bp downstream
+    '''
+    rng = np.random.default_rng(seed)
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': '1', 'LN': chr_len}, {'SN': '2', 'LN': chr_len}]}
+    with pysam.AlignmentFile(bam_file + '.unsorted.bam', 'wb', header=header) as fout:
+        for i in range(n_pairs):
+            pos = int(rng.integers(100, chr_len - 700))
+            mate_unmapped = i % 5 == 0
+            for mate in (0, 1):
+                read = pysam.AlignedSegment(fout.header)
+                read.query_name = 'read{}'.format(i)
+                read.query_sequence = 'A' * 50
+                read.is_paired = True
+                read.is_read1 = mate == 0
+                read.is_read2 = mate == 1
+                read.reference_id = 0
+                read.next_reference_id = 0
+                if mate_unmapped:
+                    # unmapped mate placed at the position of the mapped read or downstream
+                    unmapped_pos = pos + 300 * (i % 10 == 0)
+                    read.reference_start = unmapped_pos if mate == 1 else pos
+                    read.next_reference_start = pos if mate == 1 else unmapped_pos
+                    read.is_unmapped = mate == 1
+                    read.mate_is_unmapped = mate == 0
+                    read.cigarstring = None if mate == 1 else '50M'
+                else:
+                    read.is_proper_pair = i % 3 != 0
+                    read.reference_start = pos + mate * int(rng.integers(0, 500))
+                    read.next_reference_start = pos if mate else pos + 1
+                    read.is_reverse = mate == 1
+                    read.mate_is_reverse = mate == 0
+                    read.cigarstring = ('10S40M', '40M10S', '50M', '50M')[i % 4]
+                    if i % 7 == 0:
+                        read.set_tag('SA', '2,100,+,50M,60,0;')
+                read.mapping_quality = 60
+                fout.write(read)
+    pysam.sort('-o', bam_file, bam_file + '.unsorted.bam')
+    pysam.index(bam_file)
+
+
+def test_sweep_equals_fetch(tmp_path):
+    bam_file = str(tmp_path / 'test.bam')
+    write_bam(bam_file)
+    win, padding = 100, 10
+    rng = np.random.default_rng(2)
+    win_ids = []
+    for p in rng.integers(200, 4000, size=50):
+        # insertions (p, p+1), close and distant window pairs
+        for q in (p + 1, p + 40, p + 300, p + 310, p + 900):
+            win_ids.append('1_{}_1_{}_++'.format(p, q))
+    ch_table = get_channel_table(get_channels())
+    with pysam.AlignmentFile(bam_file, 'rb') as aln:
+        X_fetch = get_win_channels(aln, win_ids, 2 * win + padding, win, padding, False, ch_table)
+        X_sweep = get_win_channels(aln, win_ids, 2 * win + padding, win, padding, True, ch_table)
+    assert X_fetch.any()
+    np.testing.assert_array_equal(X_fetch, X_sweep)
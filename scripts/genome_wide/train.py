@@ -5,12 +5,15 @@ import argparse
 import gzip
 import json
 import logging
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from time import time
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import tensorflow as tf
 
 from sklearn.model_selection import StratifiedKFold, train_test_split
 from sklearn.utils.class_weight import compute_class_weight
@@ -25,8 +28,11 @@ from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.regularizers import l2
 from tensorflow.keras.utils import to_categorical
 
+from data_generator import (EpochIndices, InputTimer, NegativeSampler, WindowSubset,
+                            get_data_format, get_data_from_labels, get_dataset)
+from functions import get_mapclasses, get_negative_class
 from model_functions import (  # create_model_with_mcfly, train_model_with_mcfly
-    evaluate_model, get_data)
+    ThroughputLogger, TrainingCheckpoint, evaluate_model, get_data)
 
 
 def get_labels(channel_data_dir, win):
@@ -39,16 +45,25 @@ def get_labels(channel_data_dir, win):
     return labels
 
 
+def load_data(windows_list, npz_mode, svtype):
+    # windows are computed on the fly from the chromosome arrays when a label file is given
+    if window_source is not None:
+        return get_data_from_labels(svtype=svtype, **window_source)
+    return get_data(windows_list, npz_mode, svtype)
+
+
 def train_and_test_data(sampleName, npz_mode, svtype):
     # Datasets
     X, y, win_ids = get_data(sampleName, npz_mode, svtype)
 
-    X = np.array(X)
     y = np.array(y)
 
-    # split into train/validation sets
-    X_train, X_test, y_train, y_test, win_ids_train, win_ids_test = train_test_split(
-        X, y, win_ids, test_size=0.3, random_state=2, stratify=y, shuffle=True)
+    # split the indices into train/validation sets, the windows are only read on access
+    idx_train, idx_test = train_test_split(np.arange(len(y)), test_size=0.3, random_state=2,
+                                           stratify=y, shuffle=True)
+    X_train, X_test = WindowSubset(X, idx_train), WindowSubset(X, idx_test)
+    y_train, y_test = y[idx_train], y[idx_test]
+    win_ids_train, win_ids_test = win_ids[idx_train], win_ids[idx_test]
 
     return X_train, X_test, y_train, y_test, win_ids_train, win_ids_test
 
@@ -111,15 +126,51 @@ def create_model(dim_length, dim_channels, outputdim):
     return model
 
 
+def load_init_model(init_model, dim_length, dim_channels, outputdim, freeze_conv):
+    '''
+    Load a trained model to fine-tune it on new windows
+    :param init_model: trained model (HDF5)
+    :param dim_length: window length
+    :param dim_channels: number of channels
+    :param outputdim: number of classes
+    :param freeze_conv: freeze the convolutional layers, only the dense layers are trained
+    :return: compiled model
+    '''
+    model = load_model(init_model)
+    assert model.input_shape[1:] == (dim_length, dim_channels), \
+        'Windows of shape {} for a model with input shape {}'.format(
+            (dim_length, dim_channels), model.input_shape[1:])
+    assert model.output_shape[-1] == outputdim, \
+        '{} classes for a model with {} outputs'.format(outputdim, model.output_shape[-1])
+
+    if freeze_conv:
+        # the layers before Flatten: convolutions and their batch normalization
+        for layer in model.layers:
+            if isinstance(layer, Flatten):
+                break
+            layer.trainable = False
+
+    # compile again: new learning rate, trainable layers taken into account
+    model.compile(loss='categorical_crossentropy',
+                  optimizer=Adam(lr=model_params['learning_rate']),
+                  metrics=['accuracy'])
+    return model
+
+
 def train(model_fn, params, X_train, y_train, y_train_binary):
     # Design model
-    logging.info('Creating model...')
-    model = create_model(params['dim'], params['n_channels'],
-                         params['n_classes'])
+    if model_params['init_model'] is not None:
+        logging.info('Loading model {}...'.format(model_params['init_model']))
+        model = load_init_model(model_params['init_model'], params['dim'], params['n_channels'],
+                                params['n_classes'], model_params['freeze_conv'])
+    else:
+        logging.info('Creating model...')
+        model = create_model(params['dim'], params['n_channels'],
+                             params['n_classes'])
     logging.info(model.summary())
     earlystop = EarlyStopping(monitor='val_loss',
                               min_delta=0,
-                              patience=3,
+                              patience=model_params['patience'],
                               verbose=1,
                               restore_best_weights=True)
 
@@ -143,14 +194,59 @@ def train(model_fn, params, X_train, y_train, y_train_binary):
 
     logging.info('Fitting model...')
 
-    # Train model on dataset
+    # training throughput, next to metrics.csv
+    throughput_fn = os.path.join(os.path.dirname(model_fn), 'throughput.json')
+
+    # Windows are streamed batch by batch from the memory-mapped window files (or from memory)
+    idx_train, idx_val = train_test_split(np.arange(X_train.shape[0]),
+                                          test_size=model_params['validation_split'],
+                                          random_state=2, stratify=y_train, shuffle=True)
+    # seed of the window order of every epoch
+    seed = 2
+    training_indices = EpochIndices(idx_train, shuffle=True, seed=seed)
+    if model_params['negative_ratio'] is not None:
+        # balanced epochs: all the SVs and a fresh sample of the windows without SV
+        no_sv = get_negative_class(mapclasses)
+        is_negative = y_train[idx_train] == no_sv
+        training_indices = NegativeSampler(idx_train[~is_negative], idx_train[is_negative],
+                                           model_params['negative_ratio'], seed=seed)
+        counts = np.bincount(y_train[idx_train], minlength=params['n_classes']).astype(float)
+        counts[no_sv] = training_indices.n_negatives
+        class_weights = {i: counts.sum() / (np.count_nonzero(counts) * c)
+                         for i, c in enumerate(counts) if c > 0}
+        logging.info('%d windows per epoch' % len(training_indices))
+    timer = InputTimer()
+    training_dataset = get_dataset(X_train, y_train_binary, training_indices,
+                                   batch_size=model_params['batch_size'], shuffle=True,
+                                   workers=model_params['workers'],
+                                   prefetch=model_params['prefetch'], timer=timer)
+    throughput = ThroughputLogger(
+        throughput_fn, len(training_indices), model_params['batch_size'], timer,
+        model_params['workers'], data_format=get_data_format(X_train))
+    callbacks.append(throughput)
+    validation_dataset = get_dataset(X_train, y_train_binary, idx_val,
+                                     batch_size=model_params['batch_size'], shuffle=False,
+                                     workers=model_params['workers'],
+                                     prefetch=model_params['prefetch'])
+    # periodic checkpoints, the last callback to save the state of the other callbacks
+    training_checkpoint = TrainingCheckpoint(
+        model, os.path.join(os.path.dirname(model_fn), 'checkpoints'),
+        model_params['checkpoint_steps'], seed, [earlystop, checkpoint])
+    callbacks.append(training_checkpoint)
+    initial_epoch = 0
+    if model_params['resume']:
+        state = training_checkpoint.restore()
+        if state is not None:
+            initial_epoch = model_params['epochs'] if state['done'] else state['epoch']
+            # skip the batches of the epoch trained before the checkpoint
+            training_indices.epoch = state['epoch']
+            training_indices.skip = state['step'] * model_params['batch_size']
+            throughput.skip = training_indices.skip
     history = model.fit(
-        X_train,
-        y_train_binary,
-        validation_split=model_params['validation_split'],
-        batch_size=model_params['batch_size'],
+        training_dataset,
+        validation_data=validation_dataset,
         epochs=model_params['epochs'],
-        shuffle=True,
+        initial_epoch=initial_epoch,
         class_weight=class_weights,
         verbose=1,
         callbacks=callbacks)
@@ -160,8 +256,8 @@ def train(model_fn, params, X_train, y_train, y_train_binary):
 
 
 def cv_train_and_evaluate(X, y, y_binary, win_ids, train_indices, test_indices, model_dir, svtype):
-    # Generate batches from indices
-    X_train, X_test = X[train_indices], X[test_indices]
+    # Views of the folds, batches are gathered from the windows by indices
+    X_train, X_test = WindowSubset(X, train_indices), WindowSubset(X, test_indices)
     y_train, y_test = y[train_indices], y[test_indices]
     y_train_binary, y_test_binary = y_binary[train_indices], y_binary[
         test_indices]
@@ -191,62 +287,137 @@ def cv_train_and_evaluate(X, y, y_binary, win_ids, train_indices, test_indices,
 
     results = results.append(intermediate_results)
     results.to_csv(os.path.join(model_dir, 'metrics.csv'), sep='\t')
+    return results
+
+
+def init_fold_worker(params, classes, source, threads, training_windows, npz_mode, svtype,
+                     logfile):
+    '''
+    Initialize a fold worker process: set the parameters of the parent process, pin the number of
+    TensorFlow threads and load the (memory-mapped, read-only) windows shared by all the folds
+    :param params: model parameters
+    :param classes: mapping of the labels to the classes
+    :param source: window source parameters, None to load the windows files
+    :param threads: number of TensorFlow intra-op threads of the worker
+    :param training_windows: list of window files
+    :param npz_mode: window files in npz format
+    :param svtype: SV type
+    :param logfile: log file of the parent process
+    :return: None
+    '''
+    global model_params, mapclasses, window_source, fold_data
+    model_params, mapclasses, window_source = params, classes, source
+    logging.basicConfig(format='%(asctime)s %(process)d %(message)s',
+                        filename=logfile,
+                        filemode='a',
+                        level=logging.INFO)
+    # the thread pools are created on the first TensorFlow operation
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+    X, y, win_ids = load_data(training_windows, npz_mode, svtype)
+    y_binary = to_categorical(y, num_classes=len(mapclasses.keys()))
+    fold_data = (X, y, y_binary, win_ids)
 
 
-def cross_validation(training_windows, outDir, npz_mode, svtype, kfold):
-    X, y, win_ids = get_data(training_windows, npz_mode, svtype)
-    y_binary = to_categorical(y, num_classes=len(mapclasses.keys()))
+def run_fold(train_indices, test_indices, model_dir, svtype):
+    '''
+    Train and evaluate a fold in a worker process initialized by init_fold_worker
+    '''
+    t0 = time()
+    X, y, y_binary, win_ids = fold_data
+    results = cv_train_and_evaluate(X, y, y_binary, win_ids,
+                                    train_indices, test_indices, model_dir, svtype)
+    logging.info('Fold %s trained and evaluated in %f seconds' % (model_dir, time() - t0))
+    return results
+
+
+def run_folds(folds, data, training_windows, npz_mode, svtype, jobs, threads):
+    '''
+    Train and evaluate the folds, running jobs folds at the same time in separate processes.
+    Each fold writes its metrics.csv in its model directory.
+    :param folds: list of (train_indices, test_indices, model_dir)
+    :param data: windows, classes and window pair IDs loaded from training_windows
+    :param training_windows: list of window files
+    :param npz_mode: window files in npz format
+    :param svtype: SV type
+    :param jobs: number of folds trained at the same time
+    :param threads: number of TensorFlow intra-op threads per fold, 0 to share the cores
+    :return: None
+    '''
+    if model_params['resume']:
+        # folds trained and evaluated before the interruption
+        folds = [f for f in folds if not os.path.exists(os.path.join(f[2], 'metrics.csv'))]
+    if jobs == 1:
+        X, y, win_ids = data
+        y_binary = to_categorical(y, num_classes=len(mapclasses.keys()))
+        for train_indices, test_indices, model_dir in folds:
+            print('Training fold {}...'.format(model_dir))
+            cv_train_and_evaluate(X, y, y_binary, win_ids,
+                                  train_indices, test_indices, model_dir, svtype)
+        return
+
+    if threads == 0:
+        threads = max(1, len(os.sched_getaffinity(0)) // jobs)
+    logfile = logging.getLogger().handlers[0].baseFilename
+    # TensorFlow does not support fork after initialization: start fresh processes
+    with ProcessPoolExecutor(max_workers=jobs,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_fold_worker,
+                             initargs=(model_params, mapclasses, window_source, threads,
+                                       training_windows, npz_mode, svtype, logfile)) as executor:
+        futures = {executor.submit(run_fold, train_indices, test_indices, model_dir, svtype):
+                   model_dir for train_indices, test_indices, model_dir in folds}
+        for future in as_completed(futures):
+            future.result()
+            print('Fold {} done'.format(futures[future]))
+            logging.info('Fold %s done' % futures[future])
+
+
+def cross_validation(training_windows, outDir, npz_mode, svtype, kfold, jobs=1, threads=0):
+    data = load_data(training_windows, npz_mode, svtype)
+    y = data[1]
 
     # Instantiate the cross validator
     skf = StratifiedKFold(n_splits=kfold, shuffle=True, random_state=1)
 
     # Loop through the indices the split() method returns
-    for index, (train_indices, test_indices) in enumerate(skf.split(X, y)):
-        print("Training on fold " + str(index + 1) + "/" + str(kfold) + "...")
-
+    folds = []
+    for index, (train_indices, test_indices) in enumerate(skf.split(np.zeros(len(y)), y)):
         model_dir = os.path.join(outDir, 'kfold', svtype,
                                  str(index + 1))
+        folds.append((train_indices, test_indices, model_dir))
 
-        cv_train_and_evaluate(X, y, y_binary, win_ids,
-                              train_indices, test_indices, model_dir, svtype)
+    run_folds(folds, data, training_windows, npz_mode, svtype, jobs, threads)
 
 
-def cross_validation_by_chrom(training_windows, outDir, npz_mode, svtype, chrlist):
-    X, y, win_ids = get_data(training_windows, npz_mode, svtype)
-    y_binary = to_categorical(y, num_classes=len(mapclasses.keys()))
+def cross_validation_by_chrom(training_windows, outDir, npz_mode, svtype, chrlist, jobs=1,
+                              threads=0):
+    data = load_data(training_windows, npz_mode, svtype)
+    win_ids = data[2]
 
     # print(win_ids)
-    chrom_num1 = map(lambda x: x.split('_')[0], win_ids)
-
-    chrom_array = np.array([c for c in chrom_num1 if c in chrlist])
+    chrom_array = np.array([w.split('_')[0] for w in win_ids])
+    in_chrlist = np.isin(chrom_array, chrlist)
     # print(chrom_array)
 
-    cv_dict = {}
+    folds = []
 
-    for c in np.unique(chrom_array):
+    for c in np.unique(chrom_array[in_chrlist]):
         # print('Considering chromosome: {}'.format(c))
 
-        idx_chr = np.where(chrom_array == c)
-        idx_not_chr = np.where(chrom_array != c)
-
-        cv_dict[c] = (idx_not_chr, idx_chr)
-
-    # Loop through the indices the split() method returns
-    for chrom in cv_dict.keys():
-        train_indices, test_indices = cv_dict[chrom]
-
-        print("Test on chromosome " + chrom + "...")
+        idx_chr = np.flatnonzero(chrom_array == c)
+        idx_not_chr = np.flatnonzero(in_chrlist & (chrom_array != c))
 
-        model_dir = os.path.join(outDir, 'chrom', svtype, chrom)
+        model_dir = os.path.join(outDir, 'chrom', svtype, c)
+        folds.append((idx_not_chr, idx_chr, model_dir))
 
-        cv_train_and_evaluate(X, y, y_binary, win_ids,
-                              train_indices, test_indices, model_dir, svtype)
+    run_folds(folds, data, training_windows, npz_mode, svtype, jobs, threads)
 
 
 def train_and_test_model(training_name, test_name, training_windows, test_windows,
                          outDir,
                          npz_mode, svtype):
-    X_test, y_test, win_ids_test = get_data(training_windows, npz_mode, svtype)
+    X_train, y_train, win_ids_train = get_data(training_windows, npz_mode, svtype)
     X_test, y_test, win_ids_test = get_data(test_windows, npz_mode, svtype)
 
     # Parameters
@@ -322,7 +493,8 @@ def main():
                         '--svtype',
                         type=str,
                         default='DEL',
-                        help="Specify SV type")
+                        help="Specify SV type, or comma separated list of SV types for a multi-class "
+                             "model")
     parser.add_argument('-cv',
                         '--cv',
                         type=str,
@@ -388,9 +560,95 @@ def main():
                         type=float,
                         default=2.00180567e-04,
                         help="regularization rate")
+    parser.add_argument('-lb',
+                        '--labels',
+                        type=str,
+                        default=None,
+                        help="Label file: compute the windows on the fly from the chromosome arrays "
+                             "instead of loading the training windows")
+    parser.add_argument('-ca',
+                        '--carraydir',
+                        type=str,
+                        default='.',
+                        help="chr_array directory (with --labels)")
+    parser.add_argument('-bam',
+                        '--bam',
+                        type=str,
+                        default='../../data/test.bam',
+                        help="BAM file for the window specific channels (with --labels)")
+    parser.add_argument('-w',
+                        '--window',
+                        type=int,
+                        default=25,
+                        help="Window size (with --labels)")
+    parser.add_argument('-pd',
+                        '--padding',
+                        type=int,
+                        default=10,
+                        help="Length of the padding in between windows (with --labels)")
+    parser.add_argument('-ch',
+                        '--channels',
+                        type=str,
+                        default=None,
+                        help="Comma separated list of channel indices to use (with --labels)")
+    parser.add_argument('-workers',
+                        '--workers',
+                        type=int,
+                        default=4,
+                        help="Number of batches of windows read in parallel")
+    parser.add_argument('-prefetch',
+                        '--prefetch',
+                        type=int,
+                        default=10,
+                        help="Number of batches of windows to prepare in advance")
+    parser.add_argument('-neg_ratio',
+                        '--negative_ratio',
+                        type=float,
+                        default=None,
+                        help="Number of windows without SV per SV window in an epoch, drawn again "
+                             "at every epoch (default: all the windows at every epoch)")
+    parser.add_argument('-ckpt_steps',
+                        '--checkpoint_steps',
+                        type=int,
+                        default=1000,
+                        help="Number of steps between checkpoints of the training, 0 to save a "
+                             "checkpoint only at the end of every epoch")
+    parser.add_argument('-resume',
+                        '--resume',
+                        action='store_true',
+                        help="Resume the training from the last checkpoint, skipping the folds "
+                             "already evaluated")
+    parser.add_argument('-init_model',
+                        '--init_model',
+                        '--init-model',
+                        type=str,
+                        default=None,
+                        help="Fine-tune this trained model (HDF5) instead of training a new model, "
+                             "e.g. with a few epochs (-e) and a lower learning rate")
+    parser.add_argument('-freeze_conv',
+                        '--freeze_conv',
+                        action='store_true',
+                        help="With --init_model, train only the dense layers")
+    parser.add_argument('-patience',
+                        '--patience',
+                        type=int,
+                        default=3,
+                        help="Number of epochs without improvement of the validation loss before "
+                             "stopping")
+    parser.add_argument('-jobs',
+                        '--jobs',
+                        type=int,
+                        default=1,
+                        help="Number of cross-validation folds trained at the same time")
+    parser.add_argument('-threads',
+                        '--threads',
+                        type=int,
+                        default=0,
+                        help="Number of TensorFlow threads per fold with --jobs > 1 "
+                             "(default: available cores / jobs)")
     args = parser.parse_args()
     global mapclasses
-    mapclasses = {args.svtype: 0, 'no' + args.svtype: 1}
+    mapclasses = get_mapclasses(args.svtype)
     global model_params
     model_params = {
         'batch_size': args.batch_size,
@@ -401,15 +659,38 @@ def main():
         'kernel_size': args.kernel_size,
         'fc_nodes': args.fc_nodes,
         'learning_rate': args.learning_rate,
-        'regularization_rate': args.regularization_rate
+        'regularization_rate': args.regularization_rate,
+        'workers': args.workers,
+        'prefetch': args.prefetch,
+        'negative_ratio': args.negative_ratio,
+        'checkpoint_steps': args.checkpoint_steps,
+        'resume': args.resume,
+        'init_model': args.init_model,
+        'freeze_conv': args.freeze_conv,
+        'patience': args.patience
     }
+    global window_source
+    window_source = None
+    if args.labels is not None:
+        window_source = {
+            'label_file': args.labels,
+            'carrays_dir': args.carraydir,
+            'chrom_list': args.chrlist.split(','),
+            'bam': args.bam,
+            'win': args.window,
+            'padding_len': args.padding,
+            'channels': None if args.channels is None else
+            [int(c) for c in args.channels.split(',')]
+        }
     output_dir = args.outputpath
     os.makedirs(output_dir, exist_ok=True)
     logfilename = os.path.join(output_dir, args.logfile)
     FORMAT = '%(asctime)s %(message)s'
+    # the fold workers append to the log file: truncate it once, then append
+    open(logfilename, 'w').close()
     logging.basicConfig(format=FORMAT,
                         filename=logfilename,
-                        filemode='w',
+                        filemode='a',
                         level=logging.INFO)
 
     print('Writing log file to {}'.format(logfilename))
@@ -417,18 +698,19 @@ def main():
     training_windows_list = args.training_windows.split(',')
     test_windows_list = args.test_windows.split(',')
 
-    for t in training_windows_list:
-        assert os.path.exists(t)
+    if window_source is None:
+        for t in training_windows_list:
+            assert os.path.exists(t)
 
-    for t in test_windows_list:
-        assert os.path.exists(t)
+        for t in test_windows_list:
+            assert os.path.exists(t)
 
-    if len(set(test_windows_list) & set(training_windows_list)) == 0:
+    if window_source is None and len(set(test_windows_list) & set(training_windows_list)) == 0:
         train_and_test_model(
             training_name=args.training_sample_name,
             test_name=args.test_sample_name,
             training_windows=training_windows_list,
-            test_windows=args.test_windowsr,
+            test_windows=test_windows_list,
             outDir=output_dir,
             npz_mode=args.load_npz,
             svtype=args.svtype
@@ -439,13 +721,17 @@ def main():
                              outDir=output_dir,
                              npz_mode=args.load_npz,
                              svtype=args.svtype,
-                             kfold=args.kfold)
+                             kfold=args.kfold,
+                             jobs=args.jobs,
+                             threads=args.threads)
         elif args.cv == 'chrom':
             cross_validation_by_chrom(training_windows=training_windows_list,
                                       outDir=output_dir,
                                       npz_mode=args.load_npz,
                                       svtype=args.svtype,
-                                      chrlist=args.chrlist)
+                                      chrlist=args.chrlist.split(','),
+                                      jobs=args.jobs,
+                                      threads=args.threads)
     logging.info('Elapsed time training and testing = %f seconds' %
                  (time() - t0))
 
@@ -1,9 +1,11 @@
 import argparse
 import logging
+import multiprocessing
+import os
 import sys
-from skopt import gp_minimize
+from concurrent.futures import ProcessPoolExecutor
+from skopt import Optimizer
 from skopt.space import Real, Integer, Categorical
-from skopt.utils import use_named_args
 import tensorflow as tf
 import numpy as np
 from time import time
@@ -19,7 +21,8 @@ from tensorflow.keras.layers import (Activation, BatchNormalization,
 from tensorflow.keras.models import Sequential, load_model
 
 sys.path.append('../genome_wide/')
-from functions import load_windows
+from data_generator import DataGenerator
+from functions import get_class_label, get_mapclasses, load_windows
 
 
 dim_cnn_filters = Integer(low=4, high=16, name='cnn_filters')
@@ -34,8 +37,6 @@ dimensions = [dim_cnn_filters, dim_cnn_layers, dim_cnn_kernel_size, dim_cnn_fc_n
 
 default_parameters = [8, 1, 7, 6, 1e-4, 1e-1]
 
-best_accuracy = 0.0
-
 
 def create_model(X, outputdim, learning_rate, regularization_rate,
                  filters, layers, kernel_size, fc_nodes):
@@ -79,27 +80,53 @@ def create_model(X, outputdim, learning_rate, regularization_rate,
 
 
 
-@use_named_args(dimensions=dimensions)
-def fitness(cnn_filters, cnn_layers, cnn_kernel_size, cnn_fc_nodes,
-            cnn_init_learning_rate, cnn_regularization_rate):
-    global best_accuracy
-    # best_accuracy = 0.0
-    print()
-    print('cnn_filters: ', cnn_filters)
-    print('cnn_layers: ', cnn_layers)
-    print('cnn_kernel_size: ', cnn_kernel_size)
-    print('cnn_fc_nodes: ', cnn_fc_nodes)
-    print('cnn_init_learning_rate: ', cnn_init_learning_rate)
-    print('cnn_regularization_rate: ', cnn_regularization_rate)
-    print()
-
-    model = create_model(train_X, 2,
-                         learning_rate=cnn_init_learning_rate, regularization_rate=cnn_regularization_rate,
-                         filters=cnn_filters, layers=cnn_layers, kernel_size=cnn_kernel_size, fc_nodes=cnn_fc_nodes)
-    print(model.summary())
+def init_worker(windows, mapclasses, idx_train, idx_val, class_weights, batch_size, threads,
+                logfile):
+    '''
+    Initialize a trial worker process: log to the log file of the parent process, pin the number of
+    TensorFlow threads and memory-map the windows, shared read-only by all the workers
+    '''
+    global X, y_binary, train_idx, val_idx, trial_params
+    logging.basicConfig(format='%(asctime)s %(process)d %(message)s',
+                        filename=logfile,
+                        filemode='a',
+                        level=logging.INFO)
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+    randomState = 46
+    np.random.seed(randomState)
+    tf.random.set_seed(randomState)
+    X, y = load_windows(windows)
+    y = np.array([mapclasses[get_class_label(i, mapclasses)] for i in y.values()])
+    y_binary = to_categorical(y, num_classes=len(mapclasses))
+    train_idx, val_idx = idx_train, idx_val
+    trial_params = {'n_classes': len(mapclasses), 'class_weights': class_weights,
+                    'batch_size': batch_size}
+
+
+def fitness(trial, x, n_train, epochs, model_fn):
+    '''
+    Train a model with the hyperparameters x on the first n_train training windows
+    :param trial: trial number
+    :param x: list of hyperparameters, in the order of dimensions
+    :param n_train: number of training windows
+    :param epochs: maximum number of epochs
+    :param model_fn: file in which to save the model
+    :return: validation accuracy
+    '''
+    hparams = {d.name: v for d, v in zip(dimensions, x)}
+    logging.info('Trial %d: %s' % (trial, hparams))
+
+    model = create_model(X, trial_params['n_classes'],
+                         learning_rate=float(hparams['cnn_init_learning_rate']),
+                         regularization_rate=float(hparams['cnn_regularization_rate']),
+                         filters=int(hparams['cnn_filters']),
+                         layers=int(hparams['cnn_layers']),
+                         kernel_size=int(hparams['cnn_kernel_size']),
+                         fc_nodes=int(hparams['cnn_fc_nodes']))
 
     callback_log = TensorBoard(
-        log_dir='log_dir',
+        log_dir=os.path.join('log_dir', 'trial_' + str(trial)),
         histogram_freq=0,
         batch_size=32,
         write_graph=True,
@@ -114,57 +141,122 @@ def fitness(cnn_filters, cnn_layers, cnn_kernel_size, cnn_fc_nodes,
 
     callbacks = [callback_log, earlystop]
 
-    validation_data = (val_X, val_y)
+    # the windows are gathered from the memory-mapped windows in file order
+    idx = np.sort(train_idx[:n_train])
+    validation_data = DataGenerator(X, y_binary, val_idx,
+                                    batch_size=trial_params['batch_size'], shuffle=False)
 
-    history = model.fit(x=train_X[:3000], y=train_y[:3000],
-                        epochs=max_epoch, batch_size=batch_size,
+    history = model.fit(x=np.asarray(X[idx], dtype=np.float32), y=y_binary[idx],
+                        epochs=epochs, batch_size=trial_params['batch_size'],
                         shuffle=True,
                         validation_data=validation_data,
-                        class_weight=class_weights,
+                        class_weight=trial_params['class_weights'],
                         verbose=0,
                         callbacks=callbacks)
 
     accuracy = history.history['val_accuracy'][-1]
-    print()
-    print('Accuracy: {0:.2%}'.format(accuracy))
-    if accuracy > best_accuracy:
-        model.save(path_best_model)
-        best_accuracy = accuracy
+    logging.info('Trial %d: accuracy %f' % (trial, accuracy))
+    model.save(model_fn)
     del model
     tf.keras.backend.clear_session()
-    return -accuracy
+    return accuracy
+
+
+def get_trial_model_fn(path_best_model, trial):
+    root, ext = os.path.splitext(path_best_model)
+    return '{}.trial{}{}'.format(root, trial, ext)
+
+
+def successive_halving(executor, trials, points, args):
+    '''
+    Successive halving: train all the trials with args.max_train / eta^(rungs - 1) windows and
+    args.epochs / eta^(rungs - 1) epochs, keep the best 1 / eta of the trials for the next rung with
+    eta times more windows and epochs, up to args.max_train windows and args.epochs epochs.
+    With a single rung all the trials are trained with the full budget.
+    :param executor: process pool running the trials
+    :param trials: list of trial numbers
+    :param points: list of hyperparameters of the trials
+    :param args: command line arguments (eta, rungs, max_train, epochs, model)
+    :return: list of the accuracies of the last rung reached by each trial and list of the indices
+    of the trials trained with the full budget (last rung)
+    '''
+    accuracies = [0.0] * len(trials)
+    alive = list(range(len(trials)))
+    for rung in range(args.rungs):
+        scale = float(args.eta) ** (rung - args.rungs + 1)
+        n_train = max(args.batch_size, int(args.max_train * scale))
+        epochs = max(1, int(round(args.epochs * scale)))
+        logging.info('Rung %d: %d trials, %d windows, %d epochs' %
+                     (rung, len(alive), n_train, epochs))
+        futures = {i: executor.submit(fitness, trials[i], points[i], n_train, epochs,
+                                      get_trial_model_fn(args.model, trials[i]))
+                   for i in alive}
+        for i, future in futures.items():
+            accuracies[i] = future.result()
+        if rung < args.rungs - 1:
+            # drop the poor trials and their models
+            alive = sorted(alive, key=lambda i: accuracies[i], reverse=True)
+            for i in alive[max(1, len(alive) // args.eta):]:
+                os.remove(get_trial_model_fn(args.model, trials[i]))
+            alive = alive[:max(1, len(alive) // args.eta)]
+    return accuracies, sorted(alive)
 
 
 def optimize(args):
 
-    global train_X, val_X, train_y, val_y, class_weights, batch_size, max_epoch, path_best_model
-
     randomState = 46
     np.random.seed(randomState)
-    tf.random.set_seed(randomState)
-
-    batch_size = args.batch_size
-    max_epoch = args.epochs
-    path_best_model = args.model
 
-    X, y = load_windows(args.windows)
-    y = y.values()
-    mapclasses = {args.svtype: 0, 'no' + args.svtype: 1}
-    y = np.array([mapclasses[i] for i in y])
+    _, y = load_windows(args.windows)
+    mapclasses = get_mapclasses(args.svtype)
+    y = np.array([mapclasses[get_class_label(i, mapclasses)] for i in y.values()])
     classes = np.array(np.unique(y))
-    y_lab = np.asarray(y)
-    class_weights = compute_class_weight('balanced', classes, y_lab)
+    class_weights = compute_class_weight('balanced', classes, y)
     class_weights = {i: v for i, v in enumerate(class_weights)}
 
-    y = to_categorical(y, num_classes=2)
-
-    train_X, val_X, train_y, val_y = train_test_split(
-        X, y, test_size=args.validation_split, random_state=2, stratify=y, shuffle=True)
-
-    search_result = gp_minimize(func=fitness, dimensions=dimensions, acq_func='EI',
-                                n_calls=args.ncalls, x0=default_parameters, random_state=7, n_jobs=-1)
-
-    hyps = np.asarray(search_result.x)
+    # split the indices: the workers memory-map the windows
+    idx_train, idx_val = train_test_split(
+        np.arange(len(y)), test_size=args.validation_split, random_state=2, stratify=y,
+        shuffle=True)
+
+    threads = args.threads if args.threads > 0 else max(1, len(os.sched_getaffinity(0)) // args.jobs)
+    # batched Bayesian optimization: the optimizer proposes several points at a time
+    optimizer = Optimizer(dimensions=dimensions, base_estimator='GP', acq_func='EI',
+                          random_state=7)
+    best_accuracy = 0.0
+    best_x = None
+    trial = 0
+    # TensorFlow does not support fork after initialization: start fresh processes
+    with ProcessPoolExecutor(max_workers=args.jobs,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=(args.windows, mapclasses, idx_train, idx_val, class_weights,
+                                       args.batch_size, threads, args.logfile)) as executor:
+        while trial < args.ncalls:
+            n_points = min(max(args.jobs, args.eta ** (args.rungs - 1)), args.ncalls - trial)
+            points = optimizer.ask(n_points=n_points)
+            if trial == 0:
+                points[0] = default_parameters
+            trials = list(range(trial, trial + n_points))
+            accuracies, full_budget = successive_halving(executor, trials, points, args)
+            # the optimizer is only told the accuracies of the trials of the last rung: the
+            # accuracies of the pruned trials, with a smaller budget, would bias the surrogate model
+            optimizer.tell([points[i] for i in full_budget], [-accuracies[i] for i in full_budget])
+            # only this process selects the best model and its hyperparameters, among the trials
+            # of the last rung
+            for t, x, accuracy in zip(trials, points, accuracies):
+                print('Trial {0}: accuracy {1:.2%} {2}'.format(t, accuracy, x))
+                trial_model_fn = get_trial_model_fn(args.model, t)
+                if os.path.exists(trial_model_fn) and accuracy > best_accuracy:
+                    best_accuracy = accuracy
+                    best_x = x
+                    os.replace(trial_model_fn, args.model)
+                elif os.path.exists(trial_model_fn):
+                    os.remove(trial_model_fn)
+            trial += n_points
+
+    logging.info('Best accuracy %f: %s' % (best_accuracy, best_x))
+    hyps = np.asarray(best_x)
     np.save(args.hparams, hyps, allow_pickle=False)
 
 
@@ -216,12 +308,41 @@ def main():
                         type=str,
                         default='hyperparams.npy',
                         help="File with hyperparameters")
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=1,
+                        help="Number of trials run at the same time")
+    parser.add_argument('-t',
+                        '--threads',
+                        type=int,
+                        default=0,
+                        help="Number of TensorFlow threads per trial "
+                             "(default: available cores / jobs)")
+    parser.add_argument('-r',
+                        '--rungs',
+                        type=int,
+                        default=1,
+                        help="Number of rungs of successive halving, 1 to train all the trials "
+                             "with the full budget")
+    parser.add_argument('-eta',
+                        '--eta',
+                        type=int,
+                        default=3,
+                        help="Successive halving: keep 1 / eta trials at each rung")
+    parser.add_argument('-mt',
+                        '--max_train',
+                        type=int,
+                        default=3000,
+                        help="Number of training windows of the last rung")
     args = parser.parse_args()
 
     log_format = '%(asctime)s %(message)s'
+    # the trial workers append to the log file: truncate it once, then append
+    open(args.logfile, 'w').close()
     logging.basicConfig(format=log_format,
                         filename=args.logfile,
-                        filemode='w',
+                        filemode='a',
                         level=logging.INFO)
     t0 = time()
     optimize(args)